@@ -44,8 +44,7 @@ from typing import Optional, Dict, Any, List
 import time
 import logging
 
-# TODO: Import guardrail chain when implemented
-# from app.chains.guardrail import GuardrailChain
+from app.chains.guardrail import analyze_security
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -97,6 +96,14 @@ class AnalyzeResponse(BaseModel):
     retrieved_documents: Optional[List[Dict[str, Any]]] = None
 
 
+# Local pattern-engine rules -> AnalyzeResponse.threat_type
+_THREAT_TYPES = {
+    "Prompt Injection": "jailbreak",
+    "Secret Exposure": "data_leak",
+    "PII": "data_leak",
+}
+
+
 # ============================================================================
 # ENDPOINTS
 # ============================================================================
@@ -122,60 +129,40 @@ async def analyze_prompt(request: AnalyzeRequest):
     try:
         logger.info(f"Analyzing prompt: {request.prompt[:50]}...")
 
-        # TODO: Implement actual analysis pipeline
-        # For now, return a mock response
-
-        # Mock steps
-        steps = [
-            AnalysisStep(
-                name="pattern_check",
-                passed=True,
-                duration_ms=5,
-                details={"patterns_checked": ["sql_injection", "jailbreak"]}
-            ),
-            AnalysisStep(
-                name="rag_retrieval",
-                passed=True,
-                duration_ms=120,
-                details={"documents_found": 3}
-            ),
-            AnalysisStep(
-                name="llm_judge",
-                passed=True,
-                duration_ms=350,
-                details={"model": "gpt-4-turbo-preview"}
-            )
-        ]
+        # Pattern check, cache lookup and RAG retrieval run concurrently;
+        # the LLM judge only runs if none of them was definitive
+        config = request.config or AnalysisConfig()
+        trace: List[Dict[str, Any]] = []
+        verdict = await analyze_security(request.prompt, skip_cache=config.skip_cache, trace=trace)
+        steps = [AnalysisStep(**step) for step in trace]
 
         # Calculate total processing time
         processing_time_ms = int((time.time() - start_time) * 1000)
 
-        # Mock response - SAFE
+        risk_score = int(verdict.get("risk_score", 5))
+        if verdict.get("source") == "pattern":
+            confidence = 0.99
+        else:
+            # Confidence grows as risk_score moves away from the 1-10 midpoint
+            confidence = round(min(1.0, abs(risk_score - 5.5) / 4.5), 2)
+
+        if verdict["is_safe"]:
+            return AnalyzeResponse(
+                is_safe=True,
+                confidence=confidence,
+                processing_time_ms=processing_time_ms,
+                steps=steps
+            )
         return AnalyzeResponse(
-            is_safe=True,
-            confidence=0.95,
+            is_safe=False,
+            confidence=confidence,
+            threat_type=_THREAT_TYPES.get(verdict.get("violated_rule"), "policy_violation"),
+            explanation=verdict.get("reason"),
+            violated_policies=[verdict.get("violated_rule", "")],
             processing_time_ms=processing_time_ms,
             steps=steps
         )
 
-        # Example UNSAFE response (commented out):
-        # return AnalyzeResponse(
-        #     is_safe=False,
-        #     confidence=0.92,
-        #     threat_type="policy_violation",
-        #     explanation="This request violates the Data Privacy Policy section 4.2",
-        #     violated_policies=["Data Privacy Policy - Section 4.2"],
-        #     retrieved_documents=[
-        #         {
-        #             "source": "Data_Privacy_Policy.pdf",
-        #             "section": "4.2",
-        #             "content": "Customer email addresses cannot be shared..."
-        #         }
-        #     ],
-        #     processing_time_ms=processing_time_ms,
-        #     steps=steps
-        # )
-
     except Exception as e:
         logger.error(f"Error analyzing prompt: {str(e)}")
         raise HTTPException(
@@ -0,0 +1,187 @@
+"""
+Local Classifier
+In-process linear model between the pattern engine and the LLM judge
+
+Most traffic is plainly benign (or plainly an attack) and doesn't need a
+remote judge call. A logistic-regression model over hashed word unigrams
+and bigrams scores each input in-process, in tens of microseconds. Only
+inputs it is unsure about go on to RAG + LLM judge.
+
+CASCADE:
+- p(unsafe) <= allow_below  -> pass locally
+- p(unsafe) >= block_above  -> block locally
+- otherwise                 -> LLM judge
+Thresholds default to LOCAL_CLASSIFIER_ALLOW_BELOW / _BLOCK_ABOVE and can
+be overridden per gateway key (register-key).
+
+ARTIFACT:
+    A .npz file (weights, bias, n_features, version) written by
+    scripts/train_classifier.py from labelled scan logs and loaded at
+    startup from LOCAL_CLASSIFIER_PATH. The version string is reported in
+    /metrics so verdicts can be traced back to a model.
+"""
+
+from typing import Iterable, Optional, Sequence, Tuple
+import hashlib
+import re
+import time
+import zlib
+
+import numpy as np
+
+from app.core import metrics
+from app.services.verdict_cache import normalize_text
+
+classifier_stats = metrics.Counters(
+    "local_classifier", ["scored", "passed", "blocked", "escalated", "score_us_total"]
+)
+_loaded = {"version": None}
+
+
+def _classifier_snapshot() -> dict:
+    snap = classifier_stats.snapshot()
+    snap["avg_score_us"] = metrics.rate(snap["score_us_total"], snap["scored"])
+    snap["local_decision_rate"] = metrics.rate(snap["passed"] + snap["blocked"], snap["scored"])
+    snap["version"] = _loaded["version"]
+    return snap
+
+
+metrics.register("local_classifier", _classifier_snapshot)
+
+
+def set_loaded_version(version: Optional[str]) -> None:
+    """Version of the model serving traffic, as reported in /metrics."""
+    _loaded["version"] = version
+
+
+_TOKEN_RE = re.compile(r"\w+")
+DEFAULT_FEATURES = 2 ** 18
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+class HashedNgramClassifier:
+    """
+    Logistic regression on hashed word n-grams
+
+    Usage:
+        model = HashedNgramClassifier.train(texts, labels, version="2026-10-17")
+        model.save("data/local_classifier.npz")
+        model = HashedNgramClassifier.load("data/local_classifier.npz")
+        model.predict_proba("What is your refund policy?")  # p(unsafe)
+    """
+
+    def __init__(self, weights: np.ndarray, bias: float = 0.0, version: str = ""):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.n_features = len(self.weights)
+        self.version = version or hashlib.sha256(self.weights.tobytes()).hexdigest()[:12]
+
+    def features(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Hashed unigram + bigram counts as (indices, L2-normalized values)."""
+        tokens = _TOKEN_RE.findall(normalize_text(text))
+        grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        if not grams:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        hashed = np.fromiter(
+            (zlib.crc32(g.encode("utf-8")) % self.n_features for g in grams),
+            dtype=np.int64, count=len(grams),
+        )
+        indices, counts = np.unique(hashed, return_counts=True)
+        values = counts.astype(np.float32)
+        return indices, values / np.linalg.norm(values)
+
+    def predict_proba(self, text: str) -> float:
+        """Probability that text is unsafe."""
+        indices, values = self.features(text)
+        return float(_sigmoid(self.weights[indices] @ values + self.bias))
+
+    @classmethod
+    def train(
+        cls,
+        texts: Sequence[str],
+        labels: Sequence[int],
+        n_features: int = DEFAULT_FEATURES,
+        epochs: int = 8,
+        learning_rate: float = 0.5,
+        l2: float = 1e-6,
+        version: str = "",
+        seed: int = 0,
+    ) -> "HashedNgramClassifier":
+        """SGD on the log loss. labels: 1 = unsafe (blocked), 0 = safe."""
+        model = cls(np.zeros(n_features, dtype=np.float32))
+        samples = [model.features(t) for t in texts]
+        y = np.asarray(labels, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            lr = learning_rate / (1 + epoch)
+            for i in rng.permutation(len(samples)):
+                indices, values = samples[i]
+                error = _sigmoid(model.weights[indices] @ values + model.bias) - y[i]
+                model.weights[indices] -= lr * (error * values + l2 * model.weights[indices])
+                model.bias -= lr * error
+        model.version = version or hashlib.sha256(model.weights.tobytes()).hexdigest()[:12]
+        return model
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(
+            path, weights=self.weights, bias=np.float32(self.bias),
+            n_features=np.int64(self.n_features), version=np.str_(self.version),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "HashedNgramClassifier":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["weights"], bias=float(data["bias"]), version=str(data["version"]))
+
+
+def classify(
+    model: HashedNgramClassifier, text: str, allow_below: float, block_above: float
+) -> Tuple[Optional[dict], float]:
+    """
+    Cascade step: (verdict or None to escalate, p_unsafe).
+    """
+    start = time.perf_counter()
+    p_unsafe = model.predict_proba(text)
+    classifier_stats.incr("scored")
+    classifier_stats.incr("score_us_total", int((time.perf_counter() - start) * 1_000_000))
+    if p_unsafe <= allow_below:
+        classifier_stats.incr("passed")
+        return {
+            "is_safe": True,
+            "violated_rule": "",
+            "reason": "Local classifier: confidently benign.",
+            "risk_score": max(1, round(p_unsafe * 10)),
+            "source": "classifier",
+        }, p_unsafe
+    if p_unsafe >= block_above:
+        classifier_stats.incr("blocked")
+        return {
+            "is_safe": False,
+            "violated_rule": "Classifier",
+            "reason": f"Local classifier: likely attack or policy violation (p={p_unsafe:.2f}).",
+            "risk_score": min(10, max(7, round(p_unsafe * 10))),
+            "source": "classifier",
+        }, p_unsafe
+    classifier_stats.incr("escalated")
+    return None, p_unsafe
+
+
+def read_labelled(records: Iterable[dict]) -> Tuple[list, list]:
+    """(texts, labels) from scan-log records with "text" and "is_safe" (or "label": 1 = unsafe)."""
+    texts, labels = [], []
+    for record in records:
+        text = record.get("text")
+        if not text:
+            continue
+        if "label" in record:
+            label = int(record["label"])
+        elif "is_safe" in record:
+            label = 0 if record["is_safe"] else 1
+        else:
+            continue
+        texts.append(text)
+        labels.append(label)
+    return texts, labels
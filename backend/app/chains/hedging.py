@@ -0,0 +1,123 @@
+"""
+Hedged Requests
+Bounds judge tail latency by racing a second request against a slow first one
+
+The primary judge call starts immediately. If it hasn't produced a valid
+verdict after the hedge delay (a percentile of recent primary latencies,
+JUDGE_HEDGE_PERCENTILE), a second request goes to the alternate model or
+endpoint. The first valid result wins and the other request is cancelled.
+A primary that fails or returns nothing before the delay is hedged right
+away.
+
+Only the slow tail is hedged, so at p95 roughly 5% of calls cost double,
+not all of them. A primary cancelled because the hedge won is recorded
+with its latency at cancellation (a lower bound): recording only the
+primaries that finished would hide the slow tail, and the delay would
+keep shrinking while the hedge rate kept rising. hedge_rate and
+hedge_wins in /metrics show whether the percentile is worth it.
+"""
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional, Tuple
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+from app.core import metrics
+
+hedge_stats = metrics.Counters(
+    "judge_hedging",
+    ["calls", "hedged", "primary_wins", "hedge_wins", "no_result", "timeouts"],
+)
+
+
+class LatencyTracker:
+    """
+    Recent latencies (ms) of the primary call and the hedge delay derived from them
+
+    Usage:
+        tracker = LatencyTracker(percentile=95, min_samples=20)
+        tracker.record(830.0)
+        tracker.delay_ms(default_ms=2000, min_ms=250)
+    """
+
+    def __init__(self, percentile: float = 95.0, window: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency_ms: float) -> None:
+        with self._lock:
+            self._samples.append(latency_ms)
+
+    def quantile(self, percentile: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = np.fromiter(self._samples, dtype=np.float64)
+        return float(np.percentile(samples, percentile))
+
+    def delay_ms(self, default_ms: float, min_ms: float = 0.0) -> float:
+        """Hedge delay: the tracked percentile once there are enough samples, else default_ms."""
+        value = self.quantile(self.percentile)
+        return max(min_ms, value if value is not None else default_ms)
+
+
+async def hedged_call(
+    primary: Callable[[], Awaitable[Any]],
+    hedge: Callable[[], Awaitable[Any]],
+    delay_s: float,
+    tracker: Optional[LatencyTracker] = None,
+    is_valid: Callable[[Any], bool] = lambda result: result is not None,
+) -> Tuple[Any, Optional[str]]:
+    """
+    Run primary; start hedge if primary is slower than delay_s or comes back invalid.
+
+    Returns:
+        (first valid result, "primary" | "hedge"), or (None, None) if neither produced one.
+        If both calls raised, the primary's exception is re-raised.
+    """
+    hedge_stats.incr("calls")
+    start = time.perf_counter()
+    primary_task = asyncio.ensure_future(primary())
+    if tracker is not None:
+        def record_latency(task: asyncio.Future) -> None:
+            if task.cancelled() or task.exception() is None:
+                tracker.record((time.perf_counter() - start) * 1000)
+
+        primary_task.add_done_callback(record_latency)
+    names = {primary_task: "primary"}
+    pending = {primary_task}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay_s)
+        if done and _valid_result(primary_task, is_valid):
+            hedge_stats.incr("primary_wins")
+            return primary_task.result(), "primary"
+
+        hedge_stats.incr("hedged")
+        hedge_task = asyncio.ensure_future(hedge())
+        names[hedge_task] = "hedge"
+        pending.add(hedge_task)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: names[t] != "primary"):  # primary wins ties
+                if _valid_result(task, is_valid):
+                    hedge_stats.incr(f"{names[task]}_wins")
+                    return task.result(), names[task]
+        hedge_stats.incr("no_result")
+        errors = [task.exception() for task in names if not task.cancelled() and task.exception()]
+        if len(errors) == len(names):
+            raise errors[0]
+        return None, None
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _valid_result(task: asyncio.Future, is_valid: Callable[[Any], bool]) -> bool:
+    return not task.cancelled() and task.exception() is None and is_valid(task.result())
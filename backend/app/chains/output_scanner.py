@@ -0,0 +1,178 @@
+"""
+Output Scanner
+Incremental leak detection over a streamed completion
+
+With stream: true the proxy relays provider chunks as they arrive, so the
+response can't be buffered and judged as a whole. Every chunk is scanned
+instead, and the stream is cut as soon as a violation shows up.
+
+HOW IT WORKS:
+- Local detectors (secrets, validated PII from the pattern engine) run on
+  a sliding window of the last OUTPUT_SCAN_WINDOW_CHARS characters plus
+  the new chunk, so a card number split across two chunks is still seen.
+  This is the only work done inline, so the added latency per chunk is
+  bounded by the window size. The proxy holds back the last
+  OUTPUT_SCAN_HOLDBACK_CHARS characters it has scanned, so the first digits
+  of a split card number or key never reach the client before the rest is
+  seen.
+- Text is also collected into segments that end at a sentence or
+  paragraph boundary. A finished segment that looks suspicious (mentions
+  credentials, internal or confidential material, the system prompt...)
+  is sent to the output judge (engine.judge_output: leak-focused prompt,
+  no injection patterns, no input verdict caches) as a background task, and so is one containing
+  an ungrouped card-like number (pattern engine "pii_candidate"). The stream keeps
+  flowing; a judge block is picked up on the next chunk.
+- At most OUTPUT_SCAN_MAX_ESCALATIONS judge calls run per stream at a
+  time; further suspicious segments are counted as skipped.
+
+Prompt-injection phrases are not blocked in output: a model quoting
+"ignore previous instructions" is not leaking anything.
+"""
+
+from typing import Awaitable, Callable, List, Optional
+import asyncio
+import re
+import time
+
+from app.chains.patterns import block_verdict, scan_patterns
+from app.core import metrics
+
+output_scan_stats = metrics.Counters(
+    "output_scanner",
+    [
+        "streams", "streams_cut", "chunks_scanned", "local_blocks", "escalations",
+        "escalations_skipped", "judge_blocks", "judge_errors", "scan_us_total",
+    ],
+)
+
+
+def _output_scan_snapshot() -> dict:
+    snap = output_scan_stats.snapshot()
+    snap["avg_scan_us_per_chunk"] = metrics.rate(snap["scan_us_total"], snap["chunks_scanned"])
+    return snap
+
+
+metrics.register("output_scanner", _output_scan_snapshot)
+
+OUTPUT_CATEGORIES = ("secret", "pii")
+OUTPUT_CANDIDATES = ("pii_candidate",)  # Escalated whatever the wording; injection candidates are not leaks
+
+# Sentence end followed by whitespace, or a blank line
+_BOUNDARY_RE = re.compile(r"[.!?](?=\s)|\n\s*\n")
+# A segment without any boundary is escalated anyway once it gets this long
+MAX_SEGMENT_CHARS = 2000
+
+_SUSPICIOUS_RE = re.compile(
+    r"\b(?:passwords?|passwd|api[\s_-]?keys?|access[\s_-]?tokens?|secret|credentials?|"
+    r"private[\s_-]?key|ssn|social\s+security|credit\s+card|account\s+number|"
+    r"confidential|internal\s+only|do\s+not\s+share|system\s+prompt|my\s+instructions)\b",
+    re.IGNORECASE,
+)
+
+
+class StreamingOutputScanner:
+    """
+    Per-stream scanner state
+
+    Usage:
+        scanner = StreamingOutputScanner(judge=engine.judge_output)
+        for text in chunks:
+            if (verdict := scanner.feed(text)):
+                ...  # cut the stream
+        verdict = await scanner.finish(timeout=1.0)
+    """
+
+    def __init__(
+        self,
+        judge: Optional[Callable[[str], Awaitable[dict]]] = None,
+        window_chars: int = 512,
+        max_escalations: int = 2,
+    ):
+        self.judge = judge
+        self.window_chars = window_chars
+        self.max_escalations = max(0, max_escalations)
+        self.verdict: Optional[dict] = None
+        self._window = ""
+        self._segment = ""
+        self._flagged = False  # current segment holds a PII candidate: escalate it regardless of wording
+        self._tasks: List[asyncio.Task] = []
+        output_scan_stats.incr("streams")
+
+    def feed(self, text: str) -> Optional[dict]:
+        """Scan the next piece of output. Returns a block verdict once one is found."""
+        if self.verdict is not None:
+            return self.verdict
+        self._collect_judge_results()
+        if self.verdict is not None or not text:
+            return self.verdict
+
+        start = time.perf_counter()
+        scanned = self._window + text
+        all_hits = scan_patterns(scanned)
+        hits = [hit for hit in all_hits if hit[0] in OUTPUT_CATEGORIES]
+        self._flagged = self._flagged or any(hit[0] in OUTPUT_CANDIDATES for hit in all_hits)
+        self._window = scanned[-self.window_chars:]
+        if hits:
+            output_scan_stats.incr("local_blocks")
+            self.verdict = block_verdict(hits, subject="Response")
+        else:
+            self._segment += text
+            self._escalate_finished_segments()
+        output_scan_stats.incr("chunks_scanned")
+        output_scan_stats.incr("scan_us_total", int((time.perf_counter() - start) * 1_000_000))
+        return self.verdict
+
+    async def finish(self, timeout: float) -> Optional[dict]:
+        """End of stream: judge the trailing segment and wait (bounded) for pending judge calls."""
+        if self.verdict is None and self._segment.strip():
+            self._escalate(self._segment)
+            self._segment = ""
+        pending = [task for task in self._tasks if not task.done()]
+        if pending and self.verdict is None:
+            await asyncio.wait(pending, timeout=timeout)
+        self._collect_judge_results()
+        return self.verdict
+
+    def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _escalate_finished_segments(self) -> None:
+        while True:
+            match = _BOUNDARY_RE.search(self._segment)
+            if match is not None:
+                cut = match.end()
+            elif len(self._segment) >= MAX_SEGMENT_CHARS:
+                cut = len(self._segment)
+            else:
+                return
+            segment, self._segment = self._segment[:cut], self._segment[cut:]
+            self._escalate(segment)
+
+    def _escalate(self, segment: str) -> None:
+        flagged, self._flagged = self._flagged, False
+        if self.judge is None or not (flagged or _SUSPICIOUS_RE.search(segment)):
+            return
+        if sum(not task.done() for task in self._tasks) >= self.max_escalations:
+            output_scan_stats.incr("escalations_skipped")
+            return
+        output_scan_stats.incr("escalations")
+        self._tasks.append(asyncio.ensure_future(self.judge(segment.strip())))
+
+    def _collect_judge_results(self) -> None:
+        remaining = []
+        for task in self._tasks:
+            if not task.done():
+                remaining.append(task)
+                continue
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                output_scan_stats.incr("judge_errors")
+                continue
+            result = task.result()
+            if self.verdict is None and result and not result.get("is_safe", True):
+                output_scan_stats.incr("judge_blocks")
+                self.verdict = result
+        self._tasks = remaining
@@ -0,0 +1,257 @@
+"""
+Pattern Engine
+Compiled first stage of the guardrail, runs before RAG + LLM judge
+
+Obvious attacks ("ignore previous instructions"), well-formed secrets and
+validated PII (card numbers, SSNs) are blocked locally in microseconds.
+Trivial greetings are passed locally. Everything else is ambiguous and
+escalates to the LLM judge.
+
+CARD NUMBERS:
+    Luhn alone passes ~1 in 10 arbitrary numbers, so order, tracking and
+    account numbers would be blocked as PII. A local block needs a known
+    issuer prefix (IIN) with a length that network issues, a valid Luhn
+    checksum and the network's printed grouping (4-4-4-4, Amex 4-6-5...).
+    An ungrouped digit run with a valid IIN and checksum is only a
+    candidate ("pii_candidate"): it escalates to the judge instead.
+
+INJECTION PHRASES:
+    All injection phrases are compiled into one alternation with named
+    groups, so a single regex pass over the input checks every pattern at
+    once. A phrase blocks only when it is used as an instruction. Negated
+    ("Never reveal the system prompt", "I cannot ignore previous
+    instructions") or quoted ('what does "ignore previous instructions"
+    mean?') it is only a candidate ("prompt_injection_candidate") and
+    escalates to the judge.
+"""
+
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from app.core import metrics
+
+# Rule name -> regex. Names become named groups, so keep them identifiers.
+INJECTION_PATTERNS: Dict[str, str] = {
+    "ignore_instructions": (
+        r"\b(?:ignore|disregard|forget|override|bypass)\s+(?:all\s+|any\s+|the\s+|your\s+)?"
+        r"(?:previous|prior|above|earlier|preceding|system|original)\s+"
+        r"(?:instructions?|rules?|prompts?|directions?|guidelines?)"
+    ),
+    "system_prompt_exfiltration": (
+        r"\b(?:reveal|print|show|repeat|output|leak|tell\s+me)\s+(?:me\s+)?(?:your|the)\s+"
+        r"(?:secret\s+|hidden\s+|initial\s+|full\s+)?system\s+prompt"
+    ),
+    "jailbreak_persona": (
+        r"\b(?:you\s+are\s+now\s+(?:dan|in\s+developer\s+mode)|do\s+anything\s+now"
+        r"|developer\s+mode\s+(?:enabled|on)|jailbreak\s+mode)\b"
+    ),
+    "guardrail_removal": (
+        r"\b(?:without|ignore|remove|disable)\s+(?:any\s+|all\s+|your\s+)?"
+        r"(?:safety|content)\s+(?:filters?|restrictions?|guidelines?|policies)"
+    ),
+}
+
+_INJECTION_RE = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in INJECTION_PATTERNS.items()),
+    re.IGNORECASE,
+)
+# A negation shortly before an injection phrase, in the same clause (matched against the preceding text)
+_NEGATION_RE = re.compile(
+    r"\b(?:not|never|no|cannot|(?:do|does|did|wo|ca|should|must|would|could)n['’]?t|refuses?\s+to|unable\s+to)"
+    r"\b[^.!?;,\n]{0,24}$",
+    re.IGNORECASE,
+)
+_NEGATION_LOOKBACK_CHARS = 40
+
+# Secrets with an unambiguous shape
+_SECRET_RE = re.compile(
+    r"(?P<private_key>-----BEGIN (?:RSA |EC |OPENSSH |DSA )?PRIVATE KEY-----)"
+    r"|(?P<aws_access_key>\bAKIA[0-9A-Z]{16}\b)"
+)
+
+# PII candidates; each is confirmed by a validator before blocking
+_CARD_CANDIDATE_RE = re.compile(r"(?<!\d)(?:\d[ -]?){12,18}\d(?!\d)")
+_CARD_SEPARATOR_RE = re.compile(r"[ -]")
+
+# Card network -> (IIN ranges as (low, high) over the first len(low) digits, valid lengths)
+CARD_NETWORKS: Dict[str, Tuple[Tuple[Tuple[str, str], ...], Tuple[int, ...]]] = {
+    "visa": ((("4", "4"),), (13, 16, 19)),
+    "mastercard": ((("51", "55"), ("2221", "2720")), (16,)),
+    "amex": ((("34", "34"), ("37", "37")), (15,)),
+    "discover": ((("6011", "6011"), ("644", "649"), ("65", "65")), (16, 17, 18, 19)),
+    "jcb": ((("3528", "3589"),), (16, 17, 18, 19)),
+    "diners": ((("300", "305"), ("36", "36"), ("38", "39")), (14, 15, 16)),
+    "unionpay": ((("62", "62"),), (16, 17, 18, 19)),
+}
+
+# Printed digit groupings by length (separated numbers must use one of these)
+_CARD_GROUPINGS: Dict[int, Tuple[Tuple[int, ...], ...]] = {
+    13: ((4, 4, 5),),
+    14: ((4, 6, 4),),
+    15: ((4, 6, 5),),
+    16: ((4, 4, 4, 4),),
+    17: ((4, 4, 4, 5),),
+    18: ((4, 4, 4, 6),),
+    19: ((4, 4, 4, 4, 3), (6, 13)),
+}
+_SSN_RE = re.compile(r"(?<!\d)(\d{3})-(\d{2})-(\d{4})(?!\d)")
+
+# Inputs that are safe by construction (greetings, thanks)
+_BENIGN_RE = re.compile(
+    r"(?:hi|hello|hey|hiya|yo|thanks|thank you|thx|ok|okay|good (?:morning|afternoon|evening)"
+    r"|how are you)(?: there)?[\s!.?,]*",
+    re.IGNORECASE,
+)
+
+pattern_stats = metrics.Counters(
+    "pattern_engine", ["checked", "blocked", "passed", "escalated"]
+)
+
+
+def _pattern_snapshot() -> dict:
+    snap = pattern_stats.snapshot()
+    decided = snap["blocked"] + snap["passed"]
+    snap["judge_calls_avoided"] = decided
+    snap["hit_rate"] = metrics.rate(decided, snap["checked"])
+    return snap
+
+
+metrics.register("pattern_engine", _pattern_snapshot)
+
+
+def luhn_valid(number: str) -> bool:
+    """Luhn checksum for 13-19 digit card numbers (separators ignored)."""
+    digits = [int(c) for c in number if c.isdigit()]
+    if not 13 <= len(digits) <= 19:
+        return False
+    total = 0
+    for i, d in enumerate(reversed(digits)):
+        if i % 2 == 1:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return total % 10 == 0
+
+
+def card_network(number: str) -> Optional[str]:
+    """Network whose IIN range and length match the digits of number, or None."""
+    digits = "".join(c for c in number if c.isdigit())
+    for network, (ranges, lengths) in CARD_NETWORKS.items():
+        if len(digits) not in lengths:
+            continue
+        for low, high in ranges:
+            if low <= digits[: len(low)] <= high:
+                return network
+    return None
+
+
+def card_grouped(number: str) -> bool:
+    """Whether a separated number uses a printed card grouping (4-4-4-4, 4-6-5...)."""
+    groups = tuple(len(group) for group in _CARD_SEPARATOR_RE.split(number))
+    return groups in _CARD_GROUPINGS.get(sum(groups), ())
+
+
+def ssn_valid(area: str, group: str, serial: str) -> bool:
+    """US SSN format rules: no 000/666/9xx area, no 00 group, no 0000 serial."""
+    if area in ("000", "666") or area.startswith("9"):
+        return False
+    return group != "00" and serial != "0000"
+
+
+def injection_used(text: str, start: int) -> bool:
+    """Whether the injection phrase at text[start:] is an instruction: neither negated nor inside quotes."""
+    if _NEGATION_RE.search(text[max(0, start - _NEGATION_LOOKBACK_CHARS):start]):
+        return False
+    line = text[text.rfind("\n", 0, start) + 1:start]
+    return line.count('"') % 2 == 0 and line.count("“") <= line.count("”")
+
+
+def scan_patterns(text: str) -> List[Tuple[str, str]]:
+    """
+    Run every local detector over the input.
+
+    Returns:
+        List of (category, rule) hits, e.g. [("prompt_injection", "ignore_instructions")]
+    """
+    hits: List[Tuple[str, str]] = []
+    normalized = unicodedata.normalize("NFKC", text)
+
+    for match in _INJECTION_RE.finditer(normalized):
+        category = "prompt_injection" if injection_used(normalized, match.start()) else "prompt_injection_candidate"
+        hits.append((category, match.lastgroup))
+    for match in _SECRET_RE.finditer(normalized):
+        hits.append(("secret", match.lastgroup))
+    for match in _CARD_CANDIDATE_RE.finditer(normalized):
+        number = match.group(0)
+        if not (card_network(number) and luhn_valid(number)):
+            continue
+        hits.append(("pii" if card_grouped(number) else "pii_candidate", "credit_card"))
+    for match in _SSN_RE.finditer(normalized):
+        if ssn_valid(*match.groups()):
+            hits.append(("pii", "ssn"))
+    return hits
+
+
+# Hit categories that only make the input ambiguous; they never block on their own
+CANDIDATE_CATEGORIES = ("pii_candidate", "prompt_injection_candidate")
+
+
+def blocking_hits(hits: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    return [hit for hit in hits if hit[0] not in CANDIDATE_CATEGORIES]
+
+
+_BLOCK_MESSAGES = {
+    "prompt_injection": ("Prompt Injection", "{subject} matches a known prompt-injection pattern.", 9),
+    "secret": ("Secret Exposure", "{subject} contains a credential or private key.", 9),
+    "pii": ("PII", "{subject} contains personal data ({rules}).", 8),
+}
+
+
+def block_verdict(hits: List[Tuple[str, str]], subject: str = "Input") -> dict:
+    """Block assessment for non-empty scan_patterns hits; the first hit's category decides."""
+    category = hits[0][0]
+    rules = sorted({rule for cat, rule in hits if cat == category})
+    violated_rule, reason, risk_score = _BLOCK_MESSAGES[category]
+    return {
+        "is_safe": False,
+        "violated_rule": violated_rule,
+        "reason": reason.format(subject=subject, rules=", ".join(rules)),
+        "risk_score": risk_score,
+        "source": "pattern",
+    }
+
+
+def check_patterns(text: str, hits: Optional[List[Tuple[str, str]]] = None) -> Optional[dict]:
+    """
+    First-stage verdict.
+
+    Args:
+        text: Raw user input
+        hits: Result of scan_patterns(text) if the caller already has it
+
+    Returns:
+        An assessment dict (same shape as analyze_security) when the local
+        engine is certain, or None when the input must go to the LLM judge.
+    """
+    pattern_stats.incr("checked")
+
+    if hits is None:
+        hits = scan_patterns(text)
+    if blocking_hits(hits):
+        pattern_stats.incr("blocked")
+        return block_verdict(blocking_hits(hits))
+
+    if not hits and _BENIGN_RE.fullmatch(text.strip()):
+        pattern_stats.incr("passed")
+        return {
+            "is_safe": True,
+            "violated_rule": "None",
+            "reason": "Greeting; no policy concerns.",
+            "risk_score": 1,
+            "source": "pattern",
+        }
+
+    pattern_stats.incr("escalated")
+    return None
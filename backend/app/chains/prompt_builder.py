@@ -0,0 +1,160 @@
+"""
+Judge Prompt Builder
+Token-counted, deduplicated policy context for the LLM judge
+
+Retrieved policy chunks used to be pasted into the judge prompt as-is.
+The ingest chunker overlaps neighbouring chunks (CHUNK_OVERLAP=50), so two
+adjacent hits repeat text, and nothing bounded the context size. Judge
+latency grows with prompt length, so the builder:
+
+- merges chunks that overlap (suffix of one == prefix of the next) and
+  drops chunks contained in another
+- collapses whitespace and numbers the rules ("R1. ...") so the same
+  rules always render the same way
+- keeps whole rules until the model's token budget
+  (JUDGE_CONTEXT_TOKEN_BUDGETS, else JUDGE_CONTEXT_TOKEN_BUDGET) is used,
+  truncating only a first rule that alone is over budget
+
+TOKENS:
+    Counted with tiktoken once load_tokenizer() has run (the engine does
+    it during warmup, since the BPE file may have to be downloaded).
+    Until then, or without tiktoken, ~4 characters per token is assumed.
+"""
+
+from typing import List, NamedTuple, Optional, Sequence
+
+from app.core import metrics
+
+prompt_stats = metrics.Counters(
+    "judge_prompt",
+    ["builds", "chunks_in", "chunks_merged", "chunks_dropped", "raw_context_tokens", "context_tokens", "truncated"],
+)
+
+
+def _prompt_snapshot() -> dict:
+    snap = prompt_stats.snapshot()
+    snap["saved_tokens"] = snap["raw_context_tokens"] - snap["context_tokens"]
+    snap["avg_saved_tokens"] = metrics.rate(snap["saved_tokens"], snap["builds"])
+    snap["saved_ratio"] = metrics.rate(snap["saved_tokens"], snap["raw_context_tokens"])
+    snap["tokenizer"] = _tokenizer["name"]
+    return snap
+
+
+metrics.register("judge_prompt", _prompt_snapshot)
+
+CHARS_PER_TOKEN = 4
+MIN_MERGE_OVERLAP = 20  # Shorter shared prefixes/suffixes are coincidence, not chunker overlap
+_tokenizer = {"encoding": None, "name": "estimate"}
+
+
+def load_tokenizer(encoding_name: str = "cl100k_base") -> bool:
+    """Load the tiktoken encoding; False (estimate kept) if unavailable."""
+    try:
+        import tiktoken
+
+        _tokenizer["encoding"] = tiktoken.get_encoding(encoding_name)
+        _tokenizer["name"] = encoding_name
+        return True
+    except Exception as e:
+        print(f"  ⚠️ Tokenizer {encoding_name} unavailable ({type(e).__name__}), estimating tokens")
+        return False
+
+
+def count_tokens(text: str) -> int:
+    encoding = _tokenizer["encoding"]
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = _tokenizer["encoding"]
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+    return text[: max_tokens * CHARS_PER_TOKEN]
+
+
+class JudgeContext(NamedTuple):
+    """Built context plus what building it saved."""
+    text: str
+    rules: int
+    raw_tokens: int
+    tokens: int
+    truncated: bool
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.raw_tokens - self.tokens
+
+    def as_details(self) -> dict:
+        return {
+            "rules": self.rules,
+            "raw_context_tokens": self.raw_tokens,
+            "context_tokens": self.tokens,
+            "saved_tokens": self.saved_tokens,
+            "truncated": self.truncated,
+        }
+
+
+def _overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of left that is a prefix of right (>= MIN_MERGE_OVERLAP)."""
+    for size in range(min(len(left), len(right)) - 1, MIN_MERGE_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def dedupe_chunks(chunks: Sequence[str]) -> List[str]:
+    """Merge overlapping neighbours and drop contained/duplicate chunks, keeping first-seen order."""
+    kept: List[str] = []
+    for chunk in chunks:
+        chunk = " ".join(chunk.split())
+        if not chunk or any(chunk in other for other in kept):
+            if chunk:
+                prompt_stats.incr("chunks_dropped")
+            continue
+        contained = [other for other in kept if other in chunk]
+        if contained:
+            prompt_stats.incr("chunks_dropped", len(contained))
+            kept = [other for other in kept if other not in contained]
+        for i, other in enumerate(kept):
+            if (size := _overlap(other, chunk)):
+                kept[i] = other + chunk[size:]
+                break
+            if (size := _overlap(chunk, other)):
+                kept[i] = chunk + other[size:]
+                break
+        else:
+            kept.append(chunk)
+            continue
+        prompt_stats.incr("chunks_merged")
+    return kept
+
+
+def build_context(chunks: Sequence[str], budget_tokens: Optional[int]) -> JudgeContext:
+    """Compact, numbered rule block for the judge prompt within budget_tokens (None = unbounded)."""
+    prompt_stats.incr("builds")
+    prompt_stats.incr("chunks_in", len(chunks))
+    raw_tokens = count_tokens("\n\n".join(chunks))
+
+    lines: List[str] = []
+    used = 0
+    truncated = False
+    for number, rule in enumerate(dedupe_chunks(chunks), 1):
+        line = f"R{number}. {rule}"
+        cost = count_tokens(line) + (1 if lines else 0)
+        if budget_tokens is not None and used + cost > budget_tokens:
+            if not lines:  # a single oversized rule: keep its beginning rather than nothing
+                lines.append(truncate_to_tokens(line, budget_tokens))
+            truncated = True
+            break
+        lines.append(line)
+        used += cost
+
+    text = "\n".join(lines)
+    tokens = count_tokens(text)
+    prompt_stats.incr("raw_context_tokens", raw_tokens)
+    prompt_stats.incr("context_tokens", tokens)
+    if truncated:
+        prompt_stats.incr("truncated")
+    return JudgeContext(text=text, rules=len(lines), raw_tokens=raw_tokens, tokens=tokens, truncated=truncated)
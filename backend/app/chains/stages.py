@@ -0,0 +1,133 @@
+"""
+Stage Scheduler
+Runs independent guardrail stages concurrently with early exit
+
+The verdict-cache lookup, policy retrieval (and any cheap classifier)
+don't depend on each other, so they start together instead of one after
+another. Synchronous microsecond stages such as the pattern check run
+inline first via run_local_stage, so an obvious block never starts a
+remote call at all. Each stage returns a StageOutput: a definitive verdict
+(block or pass) or None, plus any output later stages need (e.g.
+retrieved documents).
+
+As soon as one stage returns a definitive verdict, every stage still
+running is cancelled. If several finish in the same tick, a block wins,
+then the stage listed first.
+
+Every stage is timed, and StageResult.as_step() produces the dict shape of
+AnalysisStep in app/api/endpoints/analyze.py.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+import asyncio
+import time
+
+from app.core import metrics
+
+scheduler_stats = metrics.Counters(
+    "stage_scheduler", ["runs", "early_exits", "stages_cancelled", "stages_failed"]
+)
+
+
+class StageOutput(NamedTuple):
+    """What a stage coroutine returns."""
+    verdict: Optional[dict] = None  # definitive assessment, or None to keep going
+    output: Any = None  # data for later stages
+    details: Dict[str, Any] = {}
+
+
+@dataclass
+class StageResult:
+    """Outcome and timing of one stage."""
+    name: str
+    status: str = "pending"  # completed | cancelled | failed
+    verdict: Optional[dict] = None
+    output: Any = None
+    error: Optional[BaseException] = None
+    details: Dict[str, Any] = field(default_factory=dict)
+    duration_ms: float = 0.0
+
+    def as_step(self) -> Dict[str, Any]:
+        """AnalysisStep-compatible dict (name, passed, duration_ms, details)."""
+        details = dict(self.details)
+        details["status"] = self.status
+        details["decided"] = self.verdict is not None
+        if self.error is not None:
+            details["error"] = f"{type(self.error).__name__}: {self.error}"
+        return {
+            "name": self.name,
+            "passed": self.verdict is None or bool(self.verdict["is_safe"]),
+            "duration_ms": int(round(self.duration_ms)),
+            "details": details,
+        }
+
+
+def run_local_stage(name: str, stage: Callable[[], StageOutput]) -> StageResult:
+    """
+    Run a synchronous microsecond-scale stage (e.g. pattern checks) inline.
+    Cheaper than a task, and a block here means no remote stage is ever started.
+    """
+    result = StageResult(name=name)
+    start = time.perf_counter()
+    outcome = stage()
+    result.duration_ms = (time.perf_counter() - start) * 1000
+    result.verdict, result.output, result.details = outcome.verdict, outcome.output, dict(outcome.details)
+    result.status = "completed"
+    return result
+
+
+async def _timed(result: StageResult, stage: Awaitable[StageOutput]) -> StageResult:
+    start = time.perf_counter()
+    try:
+        outcome = await stage
+        result.verdict, result.output, result.details = outcome.verdict, outcome.output, dict(outcome.details)
+        result.status = "completed"
+    except asyncio.CancelledError:
+        result.status = "cancelled"
+        raise
+    except Exception as e:
+        result.status = "failed"
+        result.error = e
+        scheduler_stats.incr("stages_failed")
+    finally:
+        result.duration_ms = (time.perf_counter() - start) * 1000
+    return result
+
+
+async def run_stages(
+    stages: Dict[str, Awaitable[StageOutput]],
+) -> Tuple[Optional[dict], Dict[str, StageResult]]:
+    """
+    Run stages concurrently until one is definitive or all have finished.
+
+    Args:
+        stages: Stage name -> coroutine returning a StageOutput
+
+    Returns:
+        (definitive verdict or None, results by stage name in the given order)
+    """
+    scheduler_stats.incr("runs")
+    results = {name: StageResult(name=name) for name in stages}
+    pending = {asyncio.ensure_future(_timed(results[name], coro)) for name, coro in stages.items()}
+    verdict = None
+    try:
+        while pending and verdict is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            finished = {task.result().name for task in done}
+            decided = [r.verdict for r in results.values() if r.name in finished and r.verdict is not None]
+            if decided:
+                blocks = [v for v in decided if not v["is_safe"]]
+                verdict = blocks[0] if blocks else decided[0]
+    finally:
+        if pending:
+            if verdict is not None:
+                scheduler_stats.incr("early_exits")
+            scheduler_stats.incr("stages_cancelled", len(pending))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for result in results.values():
+                if result.status == "pending":  # cancelled before it got to run
+                    result.status = "cancelled"
+    return verdict, results
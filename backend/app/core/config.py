@@ -6,8 +6,9 @@ This file contains all the configuration settings for the application.
 It uses pydantic-settings to load environment variables with validation.
 """
 
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Literal
 import os
 
 
@@ -20,8 +21,59 @@ class Settings(BaseSettings):
     # Application
     ENVIRONMENT: str = "development"
     LOG_LEVEL: str = "INFO"
-    MAX_PROMPT_LENGTH: int = 4000
+    MAX_PROMPT_LENGTH: int = 100000  # Longest text accepted by /scan and the proxy (422 above it)
+    SCAN_WINDOW_CHARS: int = 4000  # Longer inputs are judged as overlapping windows of this size (0 = never split)
+    SCAN_WINDOW_OVERLAP: int = 200  # Characters shared by consecutive windows (must be < SCAN_WINDOW_CHARS)
+    DEMO_MAX_PROMPT_LENGTH: int = 4000  # Longest text on the public /demo-scan (<= SCAN_WINDOW_CHARS: one window)
+
+    # Local classifier tier (scripts/train_classifier.py writes the artifact)
+    LOCAL_CLASSIFIER_PATH: str = ""  # e.g. ./data/local_classifier.npz; empty = every undecided input goes to the judge
+    LOCAL_CLASSIFIER_ALLOW_BELOW: float = 0.03  # p(unsafe) at or below this passes locally
+    LOCAL_CLASSIFIER_BLOCK_ABOVE: float = 0.97  # p(unsafe) at or above this blocks locally
     CACHE_TTL: int = 3600  # Cache Time-To-Live in seconds (1 hour)
+    GUARDRAIL_WARMUP: bool = True  # Build clients, open Chroma and pre-open TLS at startup
+
+    # Verdict cache (exact match on normalized input)
+    VERDICT_CACHE_ENABLED: bool = True
+    VERDICT_CACHE_MAX_ENTRIES: int = 10000  # In-memory LRU bound (Redis uses maxmemory)
+    POLICY_INDEX_VERSION: str = ""  # Empty = hash of the policy source files
+
+    # Semantic cache (reuse verdicts for near-duplicate prompts)
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_MAX_DISTANCE: float = 0.05  # Cosine distance; lower = stricter reuse
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 2048
+    SEMANTIC_CACHE_AUDIT_RATE: float = 0.02  # Fraction of semantic hits re-judged in the background
+
+    # Query-embedding cache (skips the remote embedding call for repeated inputs)
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 5000
+    EMBEDDING_CACHE_PATH: str = ""  # e.g. ./chroma_db/query_embeddings.npz; empty = memory only
+
+    # Micro-batching of concurrent embedding calls
+    EMBEDDING_BATCHING_ENABLED: bool = True
+    EMBEDDING_BATCH_WINDOW_MS: float = 3.0  # How long the first request waits for others
+    EMBEDDING_BATCH_MAX_ITEMS: int = 64  # Flush early once this many are queued
+
+    # Speculative upstream calls in /v1/chat/completions (keys opt in via register-key "speculative")
+    SPECULATIVE_UPSTREAM_ENABLED: bool = True  # Global kill switch
+
+    # Gateway key cache (keys resolved via the Next.js resolve-key endpoint)
+    KEY_CACHE_MAX_ENTRIES: int = 10000  # LRU bound on cached key configs
+    KEY_CACHE_TTL: int = 300  # Seconds before a resolved key is looked up again (revocations take effect)
+    KEY_CACHE_NEGATIVE_TTL: int = 30  # Seconds a rejected key is answered 403 without a lookup
+    KEY_CACHE_NEGATIVE_MAX_ENTRIES: int = 10000  # Separate LRU so a key spray can't evict valid keys
+    KEY_CACHE_REFRESH_AHEAD: float = 0.2  # Hot keys re-resolve in the background in the last 10-20% of the TTL
+
+    # SSE passthrough (stream: true on /v1/chat/completions)
+    STREAM_BUFFER_CHUNKS: int = 64  # Provider chunks buffered per stream before backpressure
+    OUTPUT_SCAN_ENABLED: bool = True  # Scan streamed output for leaks and cut the stream on a violation
+    OUTPUT_SCAN_WINDOW_CHARS: int = 512  # Sliding window the local detectors re-scan with each chunk
+    OUTPUT_SCAN_HOLDBACK_CHARS: int = 24  # Trailing output held back until scanned further (> longest grouped card)
+    OUTPUT_SCAN_MAX_ESCALATIONS: int = 2  # Concurrent judge calls per stream for suspicious sentences
+    OUTPUT_SCAN_FINAL_WAIT_MS: int = 1500  # How long the end of a stream waits for pending judge calls
+
+    # Batch scanning (POST /scan/batch)
+    BATCH_SCAN_MAX_ITEMS: int = 1000
+    BATCH_SCAN_CONCURRENCY: int = 8  # Judge calls in flight per batch
 
     # API Keys
     OPENAI_API_KEY: str = ""
@@ -38,7 +90,7 @@ class Settings(BaseSettings):
     REDIS_CACHE_ENABLED: bool = True
 
     # Vector Database
-    VECTOR_DB_TYPE: str = "chroma"  # Options: "chroma", "pinecone"
+    VECTOR_DB_TYPE: Literal["memory", "chroma"] = "memory"  # "memory": NumPy index over the Chroma store; anything else fails at startup
     CHROMA_PERSIST_DIR: str = "./chroma_db"
     PINECONE_INDEX_NAME: str = "llm-shield-policies"
 
@@ -47,6 +99,42 @@ class Settings(BaseSettings):
     LLM_MODEL: str = "gpt-4-turbo-preview"
     LLM_TEMPERATURE: float = 0.0  # Low temperature for consistent judgments
     LLM_MAX_TOKENS: int = 500
+    JUDGE_SINGLE_CALL: bool = True  # One JSON request + tolerant parsing (False = structured, then raw retry)
+    JUDGE_TRANSPORT_RETRIES: int = 1  # Retries on network/timeout/5xx/429 only, never on a bad answer
+    JUDGE_STREAMING: bool = True  # Single-call mode: pass as soon as is_safe + risk_score are streamed (blocks wait for the reason)
+    JUDGE_STREAM_FINISH_REASON: bool = False  # Keep generating the reason in the background (for logs) instead of cancelling
+    JUDGE_COMPACT: bool = False  # Judge writes only "SAFE 2" / "BLOCK 9 <rule>"; no reason on the safe path
+    JUDGE_COMPACT_EXPLAIN_BLOCKS: bool = True  # In compact mode, still explain blocks inline
+    SCAN_STORE_MAX_ENTRIES: int = 5000  # Recent scans kept for GET /scan/{id}/explanation
+    SCAN_STORE_TTL: int = 3600
+    SCAN_STORE_MAX_BYTES: int = 16_000_000  # Total prompt text kept for explanations (LRU beyond it)
+    TURN_CACHE_MAX_ENTRIES: int = 20000  # Per-message verdicts for multi-turn chats (only new turns are scanned)
+    TURN_CACHE_TTL: int = 3600
+    JUDGE_CONTEXT_TOKEN_BUDGET: int = 800  # Policy-rule tokens in the judge prompt (0 = unbounded)
+    JUDGE_CONTEXT_TOKEN_BUDGETS: dict[str, int] = {}  # Per-model overrides, JSON: {"openai/gpt-4o-mini": 600}
+    JUDGE_TIMEOUT: float = 15.0  # Seconds for the whole judge step (including hedges); on timeout GUARDRAIL_FALLBACK decides
+
+    # Degraded mode: total time for the remote checks, breakers, and what to do when they fail
+    GUARDRAIL_LATENCY_BUDGET_MS: int = 8000  # 0 = no budget (JUDGE_TIMEOUT still applies)
+    GUARDRAIL_FALLBACK: Literal["local_only", "fail_open", "fail_closed"] = "local_only"  # Anything else fails at startup
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 5  # Consecutive failures before the breaker opens
+    CIRCUIT_BREAKER_RESET_SECONDS: float = 30.0  # Open time before a single probe call is let through
+
+    # Hedged judge requests (enabled when a hedge model or base URL is set; single-call mode only)
+    JUDGE_HEDGE_MODEL: str = ""  # Alternate OpenRouter model; empty = same MODEL
+    JUDGE_HEDGE_BASE_URL: str = ""  # Alternate OpenAI-compatible endpoint; empty = OpenRouter
+    JUDGE_HEDGE_API_KEY: str = ""  # Key for JUDGE_HEDGE_BASE_URL; empty = OPENROUTER_API_KEY
+    JUDGE_HEDGE_PERCENTILE: float = 95.0  # Hedge once the primary is slower than this percentile
+    JUDGE_HEDGE_INITIAL_DELAY_MS: float = 2000  # Until enough latencies are recorded
+    JUDGE_HEDGE_MIN_DELAY_MS: float = 250
+
+    # Judge cascade: a cheap model judges first, the MODEL judge only sees what it is unsure about
+    JUDGE_CASCADE_MODEL: str = ""  # Cheap first-level OpenRouter model; empty = no cascade (single-call mode only)
+    JUDGE_CASCADE_ACCEPT_SAFE_BELOW: int = 3  # Cheap "safe" verdicts with risk_score below this are final
+    JUDGE_CASCADE_ACCEPT_BLOCK_FROM: int = 8  # Cheap blocks with risk_score at or above this are final
+    JUDGE_CASCADE_LONG_INPUT_CHARS: int = 1000  # Longer inputs only stop at the cheap level on a confident block
+    JUDGE_CASCADE_CHEAP_USD_PER_1K: float = 0.00015  # Prompt price per 1K tokens, for the savings report
+    JUDGE_CASCADE_STRONG_USD_PER_1K: float = 0.0025
 
     # Embeddings
     EMBEDDING_MODEL: str = "text-embedding-3-small"  # OpenAI embedding model
@@ -62,9 +150,16 @@ class Settings(BaseSettings):
     # CORS
     ALLOWED_ORIGINS: List[str] = ["http://localhost:5173", "http://localhost:3000"]
 
+    @model_validator(mode="after")
+    def check_scan_windows(self):
+        if self.SCAN_WINDOW_CHARS > 0 and not 0 <= self.SCAN_WINDOW_OVERLAP < self.SCAN_WINDOW_CHARS:
+            raise ValueError("SCAN_WINDOW_OVERLAP must be at least 0 and smaller than SCAN_WINDOW_CHARS")
+        return self
+
     class Config:
         env_file = ".env"
         case_sensitive = True
+        extra = "ignore"  # .env also holds guardrail vars (MODEL, OPENROUTER_API_KEY, ...)
 
 
 # Global settings instance
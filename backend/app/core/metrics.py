@@ -0,0 +1,66 @@
+"""
+Metrics
+In-process counters for the guardrail pipeline
+
+Each component (pattern engine, caches, judge, ...) owns a Counters
+instance and registers it here. GET /metrics returns a snapshot of
+every registered component so we can see how much traffic each tier
+absorbs before it reaches the LLM judge.
+
+Counters are per process: with several uvicorn workers each worker
+reports its own numbers.
+"""
+
+import threading
+from typing import Any, Callable, Dict, Iterable
+
+_registry: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+class Counters:
+    """
+    Thread-safe named integer counters for one component
+
+    Usage:
+        stats = Counters("pattern_engine", ["checked", "blocked"])
+        stats.incr("checked")
+        stats.snapshot()  # {"checked": 1, "blocked": 0}
+    """
+
+    def __init__(self, name: str, fields: Iterable[str] = ()):
+        self.name = name
+        self._lock = threading.Lock()
+        self._fields = list(fields)
+        self._values: Dict[str, float] = {f: 0 for f in self._fields}
+        register(name, self.snapshot)
+
+    def incr(self, field: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[field] = self._values.get(field, 0) + amount
+
+    def get(self, field: str) -> float:
+        with self._lock:
+            return self._values.get(field, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = {f: 0 for f in self._fields}
+
+
+def register(name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+    """Register (or replace) the snapshot function for a component."""
+    _registry[name] = collector
+
+
+def collect() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every registered component, keyed by component name."""
+    return {name: collector() for name, collector in list(_registry.items())}
+
+
+def rate(part: float, total: float) -> float:
+    """Safe ratio for hit rates; 0.0 when nothing has been counted yet."""
+    return round(part / total, 4) if total else 0.0
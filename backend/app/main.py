@@ -1,10 +1,23 @@
 import os
-from fastapi import FastAPI, HTTPException, Header, Depends
-from pydantic import BaseModel, field_validator
+import asyncio
+import json
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Header, Depends, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, field_validator, model_validator
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
-from app.chains.guardrail import analyze_security
-from litellm import completion
+from app.chains.guardrail import analyze_limited, analyze_security, engine
+from app.chains.hedging import LatencyTracker
+from app.chains.output_scanner import StreamingOutputScanner, output_scan_stats
+from app.core import metrics
+from app.core.config import settings
+from app.services.circuit_breaker import breaker_states
+from app.services.key_cache import KeyCache, key_cache_stats
+from app.services.turn_cache import message_text, turn_stats
 
 # Map our provider ids to LiteLLM model prefix (so api_key is used, not Vertex/Cloud defaults)
 LITELLM_PROVIDER_PREFIX = {
@@ -21,7 +34,43 @@ LITELLM_PROVIDER_PREFIX = {
 }
 # All other providers (openai, anthropic, deepseek, gemini, openrouter, mistral, cohere) use same id
 
-app = FastAPI()
+
+
+async def acompletion(**kwargs):
+    """litellm.acompletion, imported on first use (litellm is slow to import)."""
+    from litellm import acompletion as _acompletion
+    return await _acompletion(**kwargs)
+
+
+async def _warmup():
+    """Background startup work; /health?ready=true reports when it has finished."""
+    await asyncio.gather(
+        engine.warmup(),
+        asyncio.to_thread(__import__, "litellm"),
+        return_exceptions=True,
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start with a warm query-embedding cache if one was persisted
+    if settings.EMBEDDING_CACHE_PATH:
+        engine.embedding_cache.load(settings.EMBEDDING_CACHE_PATH)
+    # Versioned local classifier artifact (cascade tier before the LLM judge)
+    if settings.LOCAL_CLASSIFIER_PATH:
+        engine.load_classifier(settings.LOCAL_CLASSIFIER_PATH)
+    # Warm up in the background so the server accepts traffic (and /health) immediately
+    warmup_task = asyncio.create_task(_warmup()) if settings.GUARDRAIL_WARMUP else None
+    if warmup_task is None:
+        engine.ready = True  # Nothing to wait for: components build on the first request
+    yield
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    if settings.EMBEDDING_CACHE_PATH:
+        engine.embedding_cache.save(settings.EMBEDDING_CACHE_PATH)
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -33,26 +82,119 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory cache; if key missing (e.g. after restart), we resolve from Next.js DB via resolve-key
-API_KEY_MAPPING: dict[str, dict] = {}
 FRONTEND_URL = (os.getenv("FRONTEND_URL") or "http://localhost:3000").rstrip("/")
 INTERNAL_API_SECRET = os.getenv("INTERNAL_API_SECRET", "")
+# In-memory key cache; if key missing (e.g. after restart), we resolve from Next.js DB via resolve-key.
+# Registered keys only expire (or get LRU-evicted) when resolve-key can bring them back.
+API_KEY_MAPPING = KeyCache(
+    max_entries=settings.KEY_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.KEY_CACHE_TTL,
+    negative_ttl_seconds=settings.KEY_CACHE_NEGATIVE_TTL,
+    negative_max_entries=settings.KEY_CACHE_NEGATIVE_MAX_ENTRIES,
+    refresh_ahead=settings.KEY_CACHE_REFRESH_AHEAD,
+    registered_ttl_seconds=settings.KEY_CACHE_TTL if INTERNAL_API_SECRET else None,
+)
+metrics.register("key_cache", API_KEY_MAPPING.snapshot)
+# One resolve-key call per unknown key at a time; background refresh-ahead tasks
+_key_resolutions: dict[str, asyncio.Task] = {}
+_key_refresh_tasks: set = set()
+
+# Speculative upstream calls (per-key opt-in): started alongside the scan, dropped on a block
+speculation_stats = metrics.Counters(
+    "speculative_upstream",
+    ["started", "released", "cancelled_in_flight", "discarded_completed", "wasted_tokens", "overlap_ms_total"],
+)
+
+# SSE passthrough: time-to-first-token is measured from request arrival (guardrail included)
+stream_stats = metrics.Counters(
+    "chat_streaming", ["streams", "chunks", "upstream_errors", "client_disconnects"]
+)
+ttft_tracker = LatencyTracker(min_samples=1)
+
+
+def _stream_snapshot() -> dict:
+    snap = stream_stats.snapshot()
+    for p in (50, 95, 99):
+        value = ttft_tracker.quantile(p)
+        snap[f"ttft_p{p}_ms"] = round(value, 1) if value is not None else None
+    return snap
+
+
+metrics.register("chat_streaming", _stream_snapshot)
+
+def _check_length(text: str) -> str:
+    if len(text) > settings.MAX_PROMPT_LENGTH:
+        raise ValueError(f"text longer than {settings.MAX_PROMPT_LENGTH} characters")
+    return text
+
+
+def _check_thresholds(allow_below, block_above) -> tuple:
+    """Per-key classifier thresholds as floats (None = default); 0 <= allow_below < block_above <= 1."""
+    allow_below = None if allow_below is None else float(allow_below)
+    block_above = None if block_above is None else float(block_above)
+    allow = settings.LOCAL_CLASSIFIER_ALLOW_BELOW if allow_below is None else allow_below
+    block = settings.LOCAL_CLASSIFIER_BLOCK_ABOVE if block_above is None else block_above
+    if not 0 <= allow < block <= 1:
+        raise ValueError(f"classifier thresholds need 0 <= allow_below < block_above <= 1, got {allow}, {block}")
+    return allow_below, block_above
+
 
 class ScanRequest(BaseModel):
-    text: str
-    # Optional full chat messages for future use
-    messages: list = None
+    text: str = ""
+    # OpenAI-style chat history; when given it is scanned per turn and forwarded instead of text
+    messages: Optional[list[dict]] = None
+    # OpenAI-compatible: relay the completion as Server-Sent Events
+    stream: bool = False
+
+    @field_validator("messages")
+    @classmethod
+    def messages_have_roles(cls, v: Optional[list[dict]]) -> Optional[list[dict]]:
+        if v is not None and any(not isinstance(m.get("role"), str) for m in v):
+            raise ValueError("every message needs a role")
+        for message in v or []:
+            _check_length(message_text(message))
+        return v
+
+    @model_validator(mode="after")
+    def text_or_messages(self) -> "ScanRequest":
+        if not self.messages and not self.text:
+            raise ValueError("either text or messages is required")
+        _check_length(self.text)
+        return self
+
+    def chat_messages(self) -> list[dict]:
+        return self.messages or [{"role": "user", "content": self.text}]
 
 
 class ScanOnlyRequest(BaseModel):
     """Body for /scan – text only; used by MCP agent and other clients."""
     text: str
+    # Force a fresh judge call (honoured on authenticated /scan only, not the public demo)
+    skip_cache: bool = False
 
     @field_validator("text")
     @classmethod
     def text_not_empty(cls, v: str) -> str:
         if not v or not v.strip():
             raise ValueError("text must be non-empty")
+        return _check_length(v)
+
+class ScanBatchRequest(BaseModel):
+    """Body for /scan/batch – many texts (documents, tool outputs) checked in one call."""
+    texts: list[str]
+    skip_cache: bool = False
+
+    @field_validator("texts")
+    @classmethod
+    def texts_within_limits(cls, v: list[str]) -> list[str]:
+        if not v:
+            raise ValueError("texts must be non-empty")
+        if len(v) > settings.BATCH_SCAN_MAX_ITEMS:
+            raise ValueError(f"at most {settings.BATCH_SCAN_MAX_ITEMS} texts per batch")
+        if any(not t or not t.strip() for t in v):
+            raise ValueError("every text must be non-empty")
+        for t in v:
+            _check_length(t)
         return v
 
 # Request body for registering a new key (from Next.js dashboard)
@@ -61,6 +203,15 @@ class RegisterKeyRequest(BaseModel):
     provider: str
     model: str
     target_api_key: str  # Customer's actual API key
+    speculative: bool = False  # Start the upstream call while the guardrail runs (response held until it passes)
+    # Local classifier thresholds for this key (p(unsafe)); None = LOCAL_CLASSIFIER_ALLOW_BELOW / _BLOCK_ABOVE
+    classifier_allow_below: Optional[float] = None
+    classifier_block_above: Optional[float] = None
+
+    @model_validator(mode="after")
+    def thresholds_in_order(self) -> "RegisterKeyRequest":
+        _check_thresholds(self.classifier_allow_below, self.classifier_block_above)
+        return self
 
 class UnregisterKeyRequest(BaseModel):
     gateway_key: str
@@ -78,36 +229,82 @@ async def get_user_config(x_api_key: str = Header(None)):
         raise HTTPException(status_code=401, detail="Missing X-API-Key header")
     user_config = API_KEY_MAPPING.get(x_api_key)
     if user_config:
+        # Hot key near the end of its TTL: re-resolve in the background, keep serving this one
+        if INTERNAL_API_SECRET and API_KEY_MAPPING.claim_refresh(x_api_key):
+            task = asyncio.create_task(_refresh_key(x_api_key))
+            _key_refresh_tasks.add(task)
+            task.add_done_callback(_key_refresh_tasks.discard)
         out = dict(user_config)
         out["_gateway_key"] = x_api_key
         return out
     # Fallback: resolve from Redacted DB (set INTERNAL_API_SECRET + FRONTEND_URL for this)
-    if not INTERNAL_API_SECRET:
+    if not INTERNAL_API_SECRET or API_KEY_MAPPING.is_negative(x_api_key):
         raise HTTPException(status_code=403, detail="Invalid API Key")
+    task = _key_resolutions.get(x_api_key)
+    if task is None or task.get_loop() is not asyncio.get_running_loop():
+        task = asyncio.create_task(_resolve_key(x_api_key))
+        _key_resolutions[x_api_key] = task
+        task.add_done_callback(
+            lambda done: _key_resolutions.pop(x_api_key) if _key_resolutions.get(x_api_key) is done else None
+        )
+    try:
+        user_config = await asyncio.shield(task)
+    except Exception:
+        raise HTTPException(status_code=403, detail="Invalid API Key")
+    if user_config is None:
+        raise HTTPException(status_code=403, detail="Invalid API Key")
+    out = dict(user_config)
+    out["_gateway_key"] = x_api_key
+    return out
+
+
+async def _resolve_key(gateway_key: str) -> dict | None:
+    """
+    Look the key up via Next.js resolve-key and cache the outcome. Returns None
+    (and caches a negative entry) only if the key is explicitly rejected: 403/404,
+    or 200 without a customer key. Anything else (transport errors, 5xx, 429...)
+    raises and is not cached, so an outage or rate limit doesn't lock keys out.
+    """
+    key_cache_stats.incr("resolves")
     try:
         async with httpx.AsyncClient(timeout=10.0) as client:
             r = await client.get(
                 f"{FRONTEND_URL}/api/internal/resolve-key",
-                params={"key": x_api_key},
+                params={"key": gateway_key},
                 headers={"Internal-Secret": INTERNAL_API_SECRET},
             )
-        if r.status_code != 200:
-            raise HTTPException(status_code=403, detail="Invalid API Key")
-        data = r.json()
-        user_config = {
-            "provider": data.get("provider", ""),
-            "model": data.get("model") or "",
-            "api_key": data.get("customerApiKey", ""),
-        }
-        if not user_config["api_key"]:
-            raise HTTPException(status_code=403, detail="Invalid API Key")
-        API_KEY_MAPPING[x_api_key] = {k: v for k, v in user_config.items()}
-        user_config["_gateway_key"] = x_api_key
-        return user_config
-    except HTTPException:
-        raise
+        if r.status_code not in (200, 403, 404):
+            raise RuntimeError(f"resolve-key returned {r.status_code}")
+        data = r.json() if r.status_code == 200 else {}
     except Exception:
-        raise HTTPException(status_code=403, detail="Invalid API Key")
+        key_cache_stats.incr("resolve_errors")
+        raise
+    try:
+        allow_below, block_above = _check_thresholds(data.get("classifierAllowBelow"), data.get("classifierBlockAbove"))
+    except (TypeError, ValueError) as e:
+        print(f"⚠️ Ignoring invalid classifier thresholds from resolve-key: {e}")
+        allow_below, block_above = None, None
+    user_config = {
+        "provider": data.get("provider", ""),
+        "model": data.get("model") or "",
+        "api_key": data.get("customerApiKey", ""),
+        "speculative": bool(data.get("speculative", False)),
+        "classifier_allow_below": allow_below,
+        "classifier_block_above": block_above,
+    }
+    if not user_config["api_key"]:
+        API_KEY_MAPPING.set_negative(gateway_key)
+        return None
+    API_KEY_MAPPING.set(gateway_key, user_config)
+    return user_config
+
+
+async def _refresh_key(gateway_key: str) -> None:
+    try:
+        await _resolve_key(gateway_key)
+    except Exception as e:
+        print(f"⚠️ Key refresh failed, keeping cached config: {e}")
+        API_KEY_MAPPING.release_refresh(gateway_key)
 
 
 def _send_log(gateway_key: str, status: str, violation_reason: str | None = None, provider: str | None = None, model: str | None = None):
@@ -136,8 +333,34 @@ def _send_log(gateway_key: str, status: str, violation_reason: str | None = None
 
 
 @app.get("/health")
-def health_check():
-    return {"status": "ok", "message": "Server is running 🚀"}
+def health_check(ready: bool = False):
+    """
+    Liveness by default; ?ready=true is a readiness probe (503 until guardrail warmup finished,
+    200 after a failed warmup too, with warmup_error set) that also reports circuit breaker state.
+    """
+    if not ready:
+        return {"status": "ok", "message": "Server is running 🚀"}
+    # Open breakers mean scans are answered by the GUARDRAIL_FALLBACK policy, not the judge.
+    # Degraded is still "ready": the gateway keeps serving under its fallback policy.
+    breakers = breaker_states()
+    guardrail = {
+        "fallback_policy": settings.GUARDRAIL_FALLBACK,
+        "degraded": any(b["state"] != "closed" for b in breakers.values()),
+        "circuit_breakers": breakers,
+    }
+    body = {
+        "status": "ready" if engine.ready else "warming_up",
+        "warmup_ms": engine.warmup_ms,
+        "warmup_error": engine.warmup_error,
+        "guardrail": guardrail,
+    }
+    return JSONResponse(body, status_code=200 if engine.ready else 503)
+
+
+@app.get("/metrics")
+def metrics_snapshot():
+    """In-process guardrail counters (pattern engine hit rate, etc.) for this worker."""
+    return metrics.collect()
 
 
 def _list_models_gemini(api_key: str) -> list[dict]:
@@ -201,6 +424,20 @@ def list_models(req: ListModelsRequest):
     except Exception as e:
         raise HTTPException(status_code=502, detail=str(e))
 
+def _scan_response(result: dict) -> dict:
+    """Public /scan response shape for a guardrail assessment."""
+    response = {
+        "is_safe": result["is_safe"],
+        "violated_rule": result.get("violated_rule", ""),
+        "reason": result.get("reason", ""),
+        "risk_score": result.get("risk_score", 0),
+    }
+    if "span" in result:
+        # Long input scanned in windows: character offsets of the window that was blocked
+        response["span"] = result["span"]
+    return response
+
+
 # Register key endpoint (called by Next.js when user connects a provider)
 @app.post("/register-key")
 def register_key(req: RegisterKeyRequest):
@@ -211,35 +448,78 @@ def register_key(req: RegisterKeyRequest):
     API_KEY_MAPPING[req.gateway_key] = {
         "provider": req.provider,
         "model": req.model,
-        "api_key": req.target_api_key
+        "api_key": req.target_api_key,
+        "speculative": req.speculative,
+        "classifier_allow_below": req.classifier_allow_below,
+        "classifier_block_above": req.classifier_block_above,
     }
     return {"status": "registered"}
 
 # Scan-only endpoint: run guardrail on text, return safe/blocked (no LLM call).
 # Used by MCP agent (Claude Desktop tool) and any client that only needs security check.
 @app.post("/scan")
-def scan_text(req: ScanOnlyRequest, user_config: dict = Depends(get_user_config)):
+async def scan_text(req: ScanOnlyRequest, response: Response, user_config: dict = Depends(get_user_config)):
     """Scans text for PII, prompt injection, policy violations. Returns is_safe, violated_rule, reason, risk_score."""
-    result = analyze_security(req.text)
+    result = await analyze_security(
+        req.text, skip_cache=req.skip_cache, classifier_thresholds=_classifier_thresholds(user_config)
+    )
+    # X-Scan-Id lets the caller fetch an explanation later. Only verdicts whose reason was
+    # deferred (compact judge mode, mostly passes) are kept: the record holds the prompt.
+    if not result.get("reason"):
+        response.headers["X-Scan-Id"] = engine.scan_store.add(
+            owner=user_config["_gateway_key"], text=req.text, verdict=result
+        )
+    return _scan_response(result)
+
+
+# Explanation on demand: generated once per scan, only when someone asks for it.
+@app.get("/scan/{scan_id}/explanation")
+async def scan_explanation(scan_id: str, user_config: dict = Depends(get_user_config)):
+    """Returns the /scan result for scan_id with a human-readable reason."""
+    record = engine.scan_store.get(scan_id, owner=user_config["_gateway_key"])
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired scan id")
+    if not record.verdict.get("reason"):
+        # A long input blocked in one window: explain that window, not the whole text
+        span = record.verdict.get("span")
+        text = record.text[span["start"]:span["end"]] if span else record.text
+        try:
+            record.verdict["reason"] = await engine.explain(text, record.verdict)
+        except Exception as e:
+            print(f"⚠️ Explanation failed for scan {scan_id}: {e}")
+            raise HTTPException(status_code=502, detail="Could not generate explanation")
+    return {"scan_id": scan_id, **_scan_response(record.verdict)}
+
+
+# Batch scan: one embedding call for the whole batch, judge calls with bounded concurrency.
+@app.post("/scan/batch")
+async def scan_batch(req: ScanBatchRequest, user_config: dict = Depends(get_user_config)):
+    """Scans many texts; results are in input order, failed items carry an error instead of a verdict."""
+    results = await engine.analyze_batch(
+        req.texts,
+        skip_cache=req.skip_cache,
+        concurrency=settings.BATCH_SCAN_CONCURRENCY,
+        classifier_thresholds=_classifier_thresholds(user_config),
+    )
+    items = [{"error": r["error"]} if "error" in r else _scan_response(r) for r in results]
     return {
-        "is_safe": result["is_safe"],
-        "violated_rule": result.get("violated_rule", ""),
-        "reason": result.get("reason", ""),
-        "risk_score": result.get("risk_score", 0),
+        "results": items,
+        "count": len(items),
+        "failed": sum(1 for r in results if "error" in r),
     }
 
 
 # Demo scan: public endpoint for homepage demo (no auth required, guardrail only)
 @app.post("/demo-scan")
-def demo_scan(req: ScanOnlyRequest):
+async def demo_scan(req: ScanOnlyRequest):
     """Public guardrail check for the landing page demo. No API key needed."""
-    result = analyze_security(req.text)
-    return {
-        "is_safe": result["is_safe"],
-        "violated_rule": result.get("violated_rule", ""),
-        "reason": result.get("reason", ""),
-        "risk_score": result.get("risk_score", 0),
-    }
+    # Anonymous callers get one window's worth of text, never a multi-window (multi-judge-call) scan
+    if len(req.text) > settings.DEMO_MAX_PROMPT_LENGTH:
+        raise HTTPException(
+            status_code=422, detail=f"text longer than {settings.DEMO_MAX_PROMPT_LENGTH} characters"
+        )
+    result = await analyze_security(req.text)
+    return _scan_response(result)
 
 
 # Unregister key (called by Next.js when user deletes a connection)
@@ -252,14 +532,29 @@ def unregister_key(req: UnregisterKeyRequest):
 
 # Main proxy: runs security check then forwards to LLM
 @app.post("/v1/chat/completions")
-def chat_proxy(request: ScanRequest, user_config: dict = Depends(get_user_config)):
-    user_input = request.text
+async def chat_proxy(request: ScanRequest, user_config: dict = Depends(get_user_config)):
+    messages = request.chat_messages()
     gateway_key = user_config.get("_gateway_key", "")
-
-    # 1. Security check
-    security_result = analyze_security(user_input)
+    request_start = time.perf_counter()
+
+    # 1. Security check (speculative keys start the upstream call at the same time;
+    # streamed requests aren't speculated, tokens can't be held back and replayed cheaply)
+    upstream_task = None
+    if settings.SPECULATIVE_UPSTREAM_ENABLED and user_config.get("speculative") and not request.stream:
+        speculation_stats.incr("started")
+        upstream_task = asyncio.create_task(_call_upstream(user_config, messages))
+    scan_start = time.perf_counter()
+    try:
+        security_result = await _scan_conversation(messages, _classifier_thresholds(user_config))
+    except BaseException:
+        if upstream_task is not None:
+            upstream_task.cancel()
+            speculation_stats.incr("cancelled_in_flight")
+        raise
 
     if not security_result["is_safe"]:
+        if upstream_task is not None:
+            _discard_speculative(upstream_task)
         _send_log(
             gateway_key,
             "blocked",
@@ -276,39 +571,43 @@ def chat_proxy(request: ScanRequest, user_config: dict = Depends(get_user_config
         }
 
     print("  → Guardrail passed, calling LLM...")
-    
-    # 2. בניית שם המודל בצורה בטוחה 🛠️
+
+    if request.stream:
+        try:
+            upstream = await _call_upstream(user_config, messages, stream=True)
+        except Exception as e:
+            print(f"  → LLM error: {e}")
+            raise HTTPException(status_code=500, detail=f"Upstream LLM Error: {str(e)}")
+        _send_log(
+            gateway_key,
+            "passed",
+            provider=user_config.get("provider"),
+            model=user_config.get("model"),
+        )
+
+        def log_cut(verdict: dict) -> None:
+            _send_log(
+                gateway_key,
+                "blocked",
+                violation_reason=verdict.get("reason") or verdict.get("violated_rule"),
+                provider=user_config.get("provider"),
+                model=user_config.get("model"),
+            )
+
+        return StreamingResponse(
+            _relay_sse(upstream, request_start, on_cut=log_cut),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     try:
-        provider = user_config.get("provider", "").lower()
-        raw_model = user_config["model"]
-        
-        # מציאת הקידומת הנכונה ל-LiteLLM (למשל: gemini, openai, xai)
-        target_prefix = LITELLM_PROVIDER_PREFIX.get(provider) or provider
-        
-        # לוגיקה לתיקון המודל:
-        # אם אנחנו יודעים מה הקידומת הנכונה, אנחנו נכפה אותה.
-        if target_prefix and target_prefix != "other":
-            
-            # אם המודל מגיע עם לוכסן (למשל google/gemini-pro), ננקה את הקידומת הישנה
-            if "/" in raw_model:
-                _, model_suffix = raw_model.split("/", 1)
-            else:
-                model_suffix = raw_model
-                
-            # הרכבה מחדש: gemini/gemini-2.5-pro
-            final_model = f"{target_prefix}/{model_suffix}"
+        if upstream_task is not None:
+            # Buffered speculative response: released only now that the verdict is a pass
+            speculation_stats.incr("released")
+            speculation_stats.incr("overlap_ms_total", (time.perf_counter() - scan_start) * 1000)
+            response = await upstream_task
         else:
-            # במקרה של 'other' או openrouter, משאירים כמו שזה
-            final_model = raw_model
-
-        print(f"  → Calling LLM: {final_model} (timeout 90s)")
-        
-        response = completion(
-            model=final_model,
-            api_key=user_config["api_key"],
-            messages=[{"role": "user", "content": user_input}],
-            timeout=90,
-        )
+            response = await _call_upstream(user_config, messages)
         print("  → LLM response received")
         _send_log(
             gateway_key,
@@ -324,6 +623,223 @@ def chat_proxy(request: ScanRequest, user_config: dict = Depends(get_user_config
     except Exception as e:
         print(f"  → LLM error: {e}")
         raise HTTPException(status_code=500, detail=f"Upstream LLM Error: {str(e)}")
+
+
+def _upstream_model(user_config: dict) -> str:
+    """LiteLLM model id for the key's provider + model."""
+    # 2. בניית שם המודל בצורה בטוחה 🛠️
+    provider = user_config.get("provider", "").lower()
+    raw_model = user_config["model"]
+
+    # מציאת הקידומת הנכונה ל-LiteLLM (למשל: gemini, openai, xai)
+    target_prefix = LITELLM_PROVIDER_PREFIX.get(provider) or provider
+
+    # לוגיקה לתיקון המודל:
+    # אם אנחנו יודעים מה הקידומת הנכונה, אנחנו נכפה אותה.
+    if target_prefix and target_prefix != "other":
+
+        # אם המודל מגיע עם לוכסן (למשל google/gemini-pro), ננקה את הקידומת הישנה
+        if "/" in raw_model:
+            _, model_suffix = raw_model.split("/", 1)
+        else:
+            model_suffix = raw_model
+
+        # הרכבה מחדש: gemini/gemini-2.5-pro
+        return f"{target_prefix}/{model_suffix}"
+    # במקרה של 'other' או openrouter, משאירים כמו שזה
+    return raw_model
+
+
+def _classifier_thresholds(user_config: dict) -> tuple:
+    """Per-key (allow_below, block_above) for the local classifier; None entries use the defaults."""
+    return user_config.get("classifier_allow_below"), user_config.get("classifier_block_above")
+
+
+# Turns that carry untrusted input. System prompts (the customer's own instructions) and
+# assistant replies (model output, which may quote attacks) don't go through the input detectors.
+SCANNED_ROLES = ("user", "tool", "function")
+
+
+async def _scan_conversation(messages: list[dict], classifier_thresholds: tuple = None) -> dict:
+    """
+    Guardrail verdict for a whole conversation. Only user and tool turns
+    (SCANNED_ROLES) are scanned. Each turn's verdict is cached by content hash,
+    so only new or edited turns are scanned; the first blocked turn (in order)
+    blocks the request.
+    """
+    turn_stats.incr("requests")
+    policy_version = engine.policy_version
+    verdicts = {}
+    pending = []
+    scanned = (m for m in messages if m.get("role", "user") in SCANNED_ROLES)
+    for text in dict.fromkeys(message_text(m) for m in scanned):
+        if not text.strip():
+            continue
+        turn_stats.incr("turns")
+        cached = engine.turn_cache.get(text, policy_version)
+        if cached is not None:
+            turn_stats.incr("cached_turns")
+            verdicts[text] = cached
+        else:
+            pending.append(text)
+    if pending:
+        turn_stats.incr("scanned_turns", len(pending))
+        semaphore = asyncio.Semaphore(settings.BATCH_SCAN_CONCURRENCY)
+
+        async def scan_turn(text: str) -> dict:
+            return await analyze_limited(
+                analyze_security, text, semaphore, classifier_thresholds=classifier_thresholds
+            )
+
+        results = await asyncio.gather(*(scan_turn(text) for text in pending))
+        for text, result in zip(pending, results):
+            engine.turn_cache.set(text, policy_version, result)
+            verdicts[text] = result
+    if not verdicts:
+        return {"is_safe": True, "violated_rule": "", "reason": "Empty conversation", "risk_score": 0}
+    for verdict in verdicts.values():
+        if not verdict["is_safe"]:
+            turn_stats.incr("blocked")
+            return verdict
+    return max(verdicts.values(), key=lambda v: v.get("risk_score") or 0)
+
+
+async def _call_upstream(user_config: dict, messages: list[dict], stream: bool = False):
+    final_model = _upstream_model(user_config)
+    print(f"  → Calling LLM: {final_model} (timeout 90s{', streaming' if stream else ''})")
+    kwargs = {"stream": True} if stream else {}
+    return await acompletion(
+        model=final_model,
+        api_key=user_config["api_key"],
+        messages=messages,
+        timeout=90,
+        **kwargs,
+    )
+
+
+def _sse_event(payload) -> str:
+    if hasattr(payload, "model_dump_json"):
+        data = payload.model_dump_json(exclude_none=True)
+    else:
+        data = json.dumps(payload, default=str)
+    return f"data: {data}\n\n"
+
+
+async def _relay_sse(upstream, request_start: float, on_cut=None):
+    """
+    Relay provider chunks as SSE. A reader task fills a bounded queue
+    (STREAM_BUFFER_CHUNKS), so a slow client applies backpressure upstream
+    instead of buffering the whole completion in memory. on_cut(verdict) is
+    called if the output scanner cuts the stream (the request was logged as
+    passed when it started). With the scanner on, chunks are relayed only once
+    OUTPUT_SCAN_HOLDBACK_CHARS more characters have been scanned after them,
+    and the held-back tail is dropped if the stream is cut.
+    """
+    stream_stats.incr("streams")
+    queue: asyncio.Queue = asyncio.Queue(maxsize=settings.STREAM_BUFFER_CHUNKS)
+    done = object()
+
+    async def read_upstream():
+        try:
+            async for chunk in upstream:
+                await queue.put(chunk)
+        except Exception as e:
+            stream_stats.incr("upstream_errors")
+            print(f"  → LLM stream error: {e}")
+            await queue.put({"error": {"message": f"Upstream LLM Error: {e}"}})
+        finally:
+            await queue.put(done)
+
+    reader = asyncio.create_task(read_upstream())
+    scanner = None
+    if settings.OUTPUT_SCAN_ENABLED:
+        scanner = StreamingOutputScanner(
+            judge=engine.judge_output,
+            window_chars=settings.OUTPUT_SCAN_WINDOW_CHARS,
+            max_escalations=settings.OUTPUT_SCAN_MAX_ESCALATIONS,
+        )
+    holdback = settings.OUTPUT_SCAN_HOLDBACK_CHARS if scanner else 0
+    held: deque = deque()  # (chunk, text length) scanned but not yet relayed
+    held_chars = 0
+    first = True
+    completed = False
+    try:
+        while (chunk := await queue.get()) is not done:
+            if first:
+                ttft_tracker.record((time.perf_counter() - request_start) * 1000)
+                first = False
+            text = _chunk_text(chunk)
+            if scanner and (verdict := scanner.feed(text)):
+                yield _blocked_stream_event(verdict, on_cut)
+                break
+            held.append((chunk, len(text)))
+            held_chars += len(text)
+            while held and held_chars - held[0][1] >= holdback:
+                held_chars -= held[0][1]
+                stream_stats.incr("chunks")
+                yield _sse_event(held.popleft()[0])
+        else:
+            if scanner and (verdict := await scanner.finish(settings.OUTPUT_SCAN_FINAL_WAIT_MS / 1000)):
+                yield _blocked_stream_event(verdict, on_cut)
+            else:
+                for chunk, _ in held:
+                    stream_stats.incr("chunks")
+                    yield _sse_event(chunk)
+        yield "data: [DONE]\n\n"
+        completed = True
+    finally:
+        if not completed:
+            stream_stats.incr("client_disconnects")
+        if scanner:
+            scanner.close()
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        if hasattr(upstream, "aclose"):
+            await upstream.aclose()
+
+
+def _chunk_text(chunk) -> str:
+    """Text delta of one provider chunk (dict or litellm object)."""
+    if isinstance(chunk, dict):
+        choices = chunk.get("choices") or []
+        delta = (choices[0].get("delta") or {}) if choices else {}
+        return delta.get("content") or ""
+    choices = getattr(chunk, "choices", None) or []
+    delta = getattr(choices[0], "delta", None) if choices else None
+    return getattr(delta, "content", None) or ""
+
+
+def _blocked_stream_event(verdict: dict, on_cut=None) -> str:
+    """Error event that ends a stream cut by the output scanner."""
+    output_scan_stats.incr("streams_cut")
+    print(f"⛔ Stream cut: {verdict.get('violated_rule')} - {verdict.get('reason')}")
+    if on_cut is not None:
+        on_cut(verdict)
+    return _sse_event({"error": {
+        "message": "Response blocked by Redacted Security Gateway",
+        "violation": verdict.get("violated_rule"),
+        "reason": verdict.get("reason"),
+    }})
+
+
+def _discard_speculative(task: asyncio.Task) -> None:
+    """Blocked request: cancel the speculative upstream call, or count the tokens it already used."""
+    if not task.done():
+        task.cancel()
+        speculation_stats.incr("cancelled_in_flight")
+        return
+    speculation_stats.incr("discarded_completed")
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    usage = result.get("usage") if isinstance(result, dict) else getattr(result, "usage", None)
+    if isinstance(usage, dict):
+        tokens = usage.get("total_tokens") or 0
+    else:
+        tokens = getattr(usage, "total_tokens", 0) or 0
+    speculation_stats.incr("wasted_tokens", tokens)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
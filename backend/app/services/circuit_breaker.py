@@ -0,0 +1,113 @@
+"""
+Circuit Breaker
+Stops calling a remote dependency (judge LLM, embeddings) while it is failing
+
+When OpenRouter degrades, every scan used to wait for the client's full
+timeout before failing. A breaker counts consecutive failures; after
+CIRCUIT_BREAKER_FAILURE_THRESHOLD of them it opens, and calls are
+rejected immediately so the guardrail goes straight to its fallback
+policy (GUARDRAIL_FALLBACK).
+
+STATES:
+- closed: calls go through, failures are counted
+- open: calls are rejected until CIRCUIT_BREAKER_RESET_SECONDS have passed
+- half_open: one probe call is let through; success closes the breaker,
+  failure opens it again
+"""
+
+from typing import Any, Dict
+import threading
+import time
+
+from app.core import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_breakers: Dict[str, "CircuitBreaker"] = {}
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker for one dependency
+
+    Usage:
+        breaker = CircuitBreaker("judge", failure_threshold=5, reset_seconds=30)
+        if breaker.allow():
+            try:
+                call()
+                breaker.record_success()
+            except Exception:
+                breaker.record_failure()
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0, "failures": 0, "successes": 0}
+        _breakers[name] = self
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._state = HALF_OPEN
+                self._probe_started = 0.0
+            return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go out now (in half_open, only the single probe)."""
+        state = self.state
+        with self._lock:
+            if state == CLOSED:
+                return True
+            # A probe that never reported back (e.g. cancelled) doesn't block forever
+            if state == HALF_OPEN and time.monotonic() - self._probe_started >= self.reset_seconds:
+                self._probe_started = time.monotonic()
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.stats["successes"] += 1
+            self._failures = 0
+            self._state = CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.stats["failures"] += 1
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.stats["opened"] += 1
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        state = self.state
+        with self._lock:
+            snap = {"state": state, "consecutive_failures": self._failures, **self.stats}
+            if state == OPEN:
+                snap["retry_in_s"] = round(max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at)), 1)
+            return snap
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every breaker, keyed by name (used by /health and /metrics)."""
+    return {name: breaker.snapshot() for name, breaker in list(_breakers.items())}
+
+
+metrics.register("circuit_breakers", breaker_states)
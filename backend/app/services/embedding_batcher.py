@@ -0,0 +1,123 @@
+"""
+Embedding Batcher
+Coalesces concurrent query-embedding requests into batched calls
+
+Under load many /scan requests arrive within the same few milliseconds
+and each used to make its own embedding HTTP call. The batcher holds
+requests for a short window (EMBEDDING_BATCH_WINDOW_MS) or until
+EMBEDDING_BATCH_MAX_ITEMS are queued, sends them as one
+aembed_documents call and fans the vectors back out to the callers.
+
+FLUSH RULES:
+- The first request in an empty queue starts the window timer
+- Reaching max_batch flushes immediately (no waiting for the timer)
+- Identical texts in one batch are embedded once
+- A failed batch call fails every caller waiting on it; nothing is retried
+- on_outcome (e.g. a circuit breaker) hears about each remote call once,
+  not once per waiting caller
+"""
+
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+import asyncio
+
+from app.core import metrics
+
+batcher_stats = metrics.Counters(
+    "embedding_batcher",
+    ["requests", "batches", "embedded", "window_flushes", "size_flushes", "errors"],
+)
+_max_batch_size = 0
+_config = {"window_ms": 0.0, "max_batch": 0}
+
+
+def _batcher_snapshot() -> dict:
+    snap = batcher_stats.snapshot()
+    snap["avg_batch_size"] = metrics.rate(snap["requests"], snap["batches"])
+    snap["max_batch_size"] = _max_batch_size
+    snap.update(_config)
+    return snap
+
+
+metrics.register("embedding_batcher", _batcher_snapshot)
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching front for a batch embedding function
+
+    Usage:
+        batcher = EmbeddingBatcher(embeddings.aembed_documents, window_ms=3, max_batch=64)
+        vector = await batcher.embed("some prompt")
+    """
+
+    def __init__(
+        self,
+        embed_documents: Callable[[List[str]], Awaitable[List[List[float]]]],
+        window_ms: float = 3.0,
+        max_batch: int = 64,
+        on_outcome: Optional[Callable[[Optional[BaseException]], None]] = None,
+    ):
+        """
+        Args:
+            on_outcome: Called once per remote call with its exception, or None on success
+        """
+        self.embed_documents = embed_documents
+        self.on_outcome = on_outcome
+        self.window_ms = window_ms
+        self.max_batch = max(1, max_batch)
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight: set = set()
+        _config.update(window_ms=window_ms, max_batch=self.max_batch)
+
+    async def embed(self, text: str) -> List[float]:
+        """Embedding for one text, sent together with whatever else arrives in the window."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:  # e.g. a new event loop after a restart in tests
+            self._loop, self._pending, self._timer = loop, [], None
+        future = loop.create_future()
+        self._pending.append((text, future))
+        batcher_stats.incr("requests")
+        if len(self._pending) >= self.max_batch:
+            batcher_stats.incr("size_flushes")
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush_on_timer)
+        return await future
+
+    def _flush_on_timer(self) -> None:
+        batcher_stats.incr("window_flushes")
+        self._flush()
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: Sequence[Tuple[str, asyncio.Future]]) -> None:
+        global _max_batch_size
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        batcher_stats.incr("batches")
+        batcher_stats.incr("embedded", len(texts))
+        _max_batch_size = max(_max_batch_size, len(batch))
+        try:
+            vectors = dict(zip(texts, await self.embed_documents(texts)))
+        except Exception as e:
+            batcher_stats.incr("errors")
+            if self.on_outcome is not None:
+                self.on_outcome(e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if self.on_outcome is not None:
+            self.on_outcome(None)
+        for text, future in batch:
+            if not future.done():  # caller may have been cancelled meanwhile
+                future.set_result(vectors[text])
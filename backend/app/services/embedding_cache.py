@@ -0,0 +1,125 @@
+"""
+Embedding Cache Service
+Bounded in-process cache of query embeddings
+
+Every scan used to make a remote embedding call to OpenRouter before
+policy retrieval, even for inputs we embedded a second ago. This cache
+maps normalized text to its embedding so repeated inputs go straight to
+similarity_search_by_vector.
+
+STORAGE:
+- Vectors are kept as float32 NumPy arrays (half the size of Python floats
+  lists, and directly usable for dot products)
+- Keys are sha256(model + normalized text); raw prompts are never stored
+- Optional persistence (EMBEDDING_CACHE_PATH): saved as .npz on shutdown,
+  loaded on startup so restarts begin warm
+"""
+
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from app.core import metrics
+from app.services.verdict_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+embedding_stats = metrics.Counters(
+    "embedding_cache", ["lookups", "hits", "misses", "evictions", "loaded", "saved"]
+)
+
+
+def _embedding_snapshot() -> dict:
+    snap = embedding_stats.snapshot()
+    snap["hit_rate"] = metrics.rate(snap["hits"], snap["lookups"])
+    return snap
+
+
+metrics.register("embedding_cache", _embedding_snapshot)
+
+
+class EmbeddingCache:
+    """
+    LRU map from normalized text to a float32 embedding
+
+    Usage:
+        cache = EmbeddingCache(model="text-embedding-3-small", max_entries=5000)
+        vector = cache.get("hello")          # None on miss
+        cache.put("hello", [0.1, 0.2, ...])
+        cache.save("/data/embeddings.npz")
+    """
+
+    def __init__(self, model: str, max_entries: int = 5000):
+        self.model = model or ""
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """Cached embedding as a plain list (what LangChain vector stores expect), or None."""
+        embedding_stats.incr("lookups")
+        key = self._key(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+        if vector is None:
+            embedding_stats.incr("misses")
+            return None
+        embedding_stats.incr("hits")
+        return vector.tolist()
+
+    def put(self, text: str, vector: Sequence[float]) -> None:
+        self._put_key(self._key(text), np.asarray(vector, dtype=np.float32))
+
+    def _put_key(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                embedding_stats.incr("evictions")
+
+    def save(self, path: str) -> None:
+        """Write all entries (LRU order) to an .npz file atomically."""
+        with self._lock:
+            keys = list(self._entries.keys())
+            vectors = list(self._entries.values())
+        if not vectors or len({v.shape for v in vectors}) != 1:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, model=np.array(self.model), keys=np.array(keys), vectors=np.stack(vectors))
+        os.replace(tmp_path, path)
+        embedding_stats.incr("saved", len(keys))
+        logger.info(f"Saved {len(keys)} cached embeddings to {path}")
+
+    def load(self, path: str) -> int:
+        """Load entries saved by save(); skipped if the file is missing or for another model."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data["model"]) != self.model:
+                    logger.info(f"Embedding cache at {path} is for another model; ignoring")
+                    return 0
+                keys, vectors = data["keys"], data["vectors"].astype(np.float32, copy=False)
+        except Exception as e:
+            logger.warning(f"Could not load embedding cache from {path}: {e}")
+            return 0
+        for key, vector in zip(keys.tolist(), vectors):
+            self._put_key(key, vector)
+        embedding_stats.incr("loaded", len(keys))
+        logger.info(f"Loaded {len(keys)} cached embeddings from {path}")
+        return len(keys)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,217 @@
+"""
+Gateway Key Cache
+Bounded, expiring cache of resolved gateway keys, with negative entries
+
+get_user_config resolves an unknown X-API-Key through the Next.js
+resolve-key endpoint. The old plain dict never expired or shrank, and
+invalid keys were never remembered, so a client spraying random keys
+caused one HTTP call per request. This cache bounds all of that.
+
+ENTRIES:
+- positive: key -> user config, LRU-bounded (KEY_CACHE_MAX_ENTRIES) with a
+  TTL (KEY_CACHE_TTL), so revoked keys stop working without a restart
+- negative: keys resolve-key rejected, in their own smaller LRU with a short
+  TTL (KEY_CACHE_NEGATIVE_TTL), so a spray can't evict valid keys
+- registered: keys written with cache[key] = config (register-key). Without
+  a TTL for them (registered_ttl_seconds=None: resolve-key can't bring them
+  back) they are pinned, i.e. never expired or LRU-evicted
+- refresh-ahead: a key used in the last part of its TTL is re-resolved in
+  the background while the cached config keeps serving. The refresh point
+  is jittered per entry so keys cached together don't refresh together.
+
+It still behaves like the dict it replaces (register-key writes, tests
+seed keys), with per-operation stats: hits, misses and negative hits.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, MutableMapping, Optional
+import random
+import threading
+import time
+
+from app.core import metrics
+
+key_cache_stats = metrics.Counters(
+    "key_cache",
+    [
+        "hits", "misses", "negative_hits", "negative_stores", "expired",
+        "evictions", "refreshes_started", "resolves", "resolve_errors",
+    ],
+)
+
+_DEFAULT_TTL = object()
+
+
+@dataclass
+class _Entry:
+    config: Dict[str, Any]
+    expires_at: Optional[float]  # None = no TTL
+    refresh_at: Optional[float]
+    refreshing: bool = False
+    pinned: bool = False  # never LRU-evicted (a registered key nothing could re-resolve)
+
+
+class KeyCache(MutableMapping):
+    """
+    LRU/TTL mapping of gateway key -> user config, plus negative entries
+
+    Usage:
+        cache = KeyCache(max_entries=10000, ttl_seconds=300, negative_ttl_seconds=30)
+        cache.get(key)               # config or None; counts a hit or a miss
+        cache.is_negative(key)       # recently rejected by resolve-key?
+        cache.set_negative(key)
+        if cache.claim_refresh(key):
+            ...                      # re-resolve in the background
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl_seconds: Optional[float] = 300,
+        negative_ttl_seconds: float = 30,
+        negative_max_entries: int = 10000,
+        refresh_ahead: float = 0.2,
+        registered_ttl_seconds: Optional[float] = None,
+    ):
+        """
+        Args:
+            refresh_ahead: Fraction of the TTL at the end of which a hit triggers a refresh
+            registered_ttl_seconds: TTL for entries written with cache[key] = config
+                (register-key); None keeps them for good, exempt from LRU eviction
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.negative_max_entries = negative_max_entries
+        self.refresh_ahead = refresh_ahead
+        self.registered_ttl_seconds = registered_ttl_seconds
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._negative: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- Lookups ---
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                key_cache_stats.incr("misses")
+                return default
+            self._entries.move_to_end(key)
+            key_cache_stats.incr("hits")
+            return entry.config
+
+    def is_negative(self, key: str) -> bool:
+        with self._lock:
+            expires_at = self._negative.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._negative[key]
+                return False
+            key_cache_stats.incr("negative_hits")
+            return True
+
+    def claim_refresh(self, key: str) -> bool:
+        """True (once) if key is in its refresh-ahead window; the caller then refreshes it."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refreshing or entry.refresh_at is None:
+                return False
+            if time.monotonic() < entry.refresh_at:
+                return False
+            entry.refreshing = True
+            key_cache_stats.incr("refreshes_started")
+            return True
+
+    def release_refresh(self, key: str) -> None:
+        """A refresh failed: allow another attempt on a later hit."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refreshing = False
+
+    # --- Writes ---
+
+    def set(self, key: str, config: Dict[str, Any], ttl_seconds: Any = _DEFAULT_TTL, pinned: bool = False) -> None:
+        """
+        Store a resolved config (default TTL unless ttl_seconds is given; None
+        means no TTL). A pinned entry is never evicted to make room.
+        """
+        ttl = self.ttl_seconds if ttl_seconds is _DEFAULT_TTL else ttl_seconds
+        now = time.monotonic()
+        expires_at = now + ttl if ttl else None
+        refresh_at = None
+        if expires_at is not None and self.refresh_ahead > 0:
+            # Jitter: refresh somewhere in the last refresh_ahead..refresh_ahead/2 of the TTL
+            refresh_at = expires_at - ttl * self.refresh_ahead * random.uniform(0.5, 1.0)
+        with self._lock:
+            self._negative.pop(key, None)
+            self._entries[key] = _Entry(dict(config), expires_at, refresh_at, pinned=pinned)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                victim = next((k for k, entry in self._entries.items() if not entry.pinned), None)
+                if victim is None:
+                    break
+                del self._entries[victim]
+                key_cache_stats.incr("evictions")
+
+    def set_negative(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._negative[key] = time.monotonic() + self.negative_ttl_seconds
+            self._negative.move_to_end(key)
+            while len(self._negative) > self.negative_max_entries:
+                self._negative.popitem(last=False)
+            key_cache_stats.incr("negative_stores")
+
+    # --- dict interface (register-key / unregister-key, tests) ---
+
+    def __setitem__(self, key: str, config: Dict[str, Any]) -> None:
+        self.set(
+            key, config, ttl_seconds=self.registered_ttl_seconds, pinned=self.registered_ttl_seconds is None
+        )
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                raise KeyError(key)
+            return entry.config
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            del self._entries[key]
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return self._live_entry(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._negative.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        snap = key_cache_stats.snapshot()
+        lookups = snap["hits"] + snap["misses"]
+        snap["hit_rate"] = metrics.rate(snap["hits"], lookups)
+        snap["size"] = len(self._entries)
+        snap["negative_size"] = len(self._negative)
+        return snap
+
+    def _live_entry(self, key) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at is not None and entry.expires_at < time.monotonic():
+            del self._entries[key]
+            key_cache_stats.incr("expired")
+            return None
+        return entry
@@ -0,0 +1,99 @@
+"""
+Scan Store
+Short-lived record of recent /scan calls, for explanations on demand
+
+In compact judge mode the judge only returns a verdict code and a risk
+score; nobody reads a reason for the (common) safe case, so none is
+generated. /scan returns an X-Scan-Id header, and
+GET /scan/{id}/explanation uses the record kept here to ask the judge
+for the human-readable explanation later.
+
+Records hold the scanned text (user prompts, possibly PII), so only scans
+whose reason was deferred are stored at all, the store is bounded by
+entry count and by total text size (SCAN_STORE_MAX_BYTES, LRU), records
+expire after SCAN_STORE_TTL seconds, and only the gateway key that made
+the scan can read them back.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+import threading
+import time
+import uuid
+
+
+@dataclass
+class ScanRecord:
+    """One scan: what was checked, by whom, and the verdict."""
+    scan_id: str
+    owner: str
+    text: str
+    verdict: Dict[str, Any]
+    expires_at: float = field(default=0.0)
+
+
+class ScanStore:
+    """
+    Bounded LRU of scan records with a TTL
+
+    Usage:
+        store = ScanStore(max_entries=5000, ttl_seconds=3600, max_bytes=16_000_000)
+        scan_id = store.add(owner=gateway_key, text=text, verdict=verdict)
+        record = store.get(scan_id, owner=gateway_key)  # None if unknown/expired/not yours
+    """
+
+    def __init__(self, max_entries: int = 5000, ttl_seconds: int = 3600, max_bytes: int = 16_000_000):
+        """
+        Args:
+            max_bytes: Budget for the stored texts (UTF-8); a single text over it isn't kept
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._records: "OrderedDict[str, ScanRecord]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, owner: str, text: str, verdict: Dict[str, Any]) -> str:
+        scan_id = uuid.uuid4().hex
+        record = ScanRecord(
+            scan_id=scan_id,
+            owner=owner,
+            text=text,
+            verdict=dict(verdict),
+            expires_at=time.monotonic() + self.ttl_seconds,
+        )
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            self._records[scan_id] = record
+            self._sizes[scan_id] = size
+            self._bytes += size
+            while self._records and (len(self._records) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._records)))
+        return scan_id
+
+    def get(self, scan_id: str, owner: str) -> Optional[ScanRecord]:
+        with self._lock:
+            record = self._records.get(scan_id)
+            if record is None:
+                return None
+            if record.expires_at < time.monotonic():
+                self._remove(scan_id)
+                return None
+            if record.owner != owner:
+                return None
+            self._records.move_to_end(scan_id)
+            return record
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def _remove(self, scan_id: str) -> None:
+        del self._records[scan_id]
+        self._bytes -= self._sizes.pop(scan_id)
+
+    def __len__(self) -> int:
+        return len(self._records)
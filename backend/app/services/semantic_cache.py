@@ -0,0 +1,157 @@
+"""
+Semantic Verdict Cache
+Second-level cache that reuses a verdict for near-duplicate prompts
+
+The exact-match cache misses paraphrases of the same benign question and
+the same jailbreak template with small edits. This cache keeps the query
+embedding of every judged prompt in one contiguous float32 matrix; a new
+prompt whose embedding is within SEMANTIC_CACHE_MAX_DISTANCE (cosine
+distance) of a cached one reuses that verdict.
+
+Lookup is a single matrix-vector product over unit-normalized rows, so it
+stays in-process and well under a millisecond for a few thousand entries.
+The matrix is a ring buffer: when full, the oldest entry is overwritten.
+
+AUDITS:
+    A sample of semantic hits (SEMANTIC_CACHE_AUDIT_RATE) is re-judged in
+    the background and compared with the reused verdict. Disagreements are
+    counted as false reuse, so the distance threshold can be tuned, and the
+    entries that produced the hit are invalidated.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import logging
+import threading
+import time
+
+import numpy as np
+
+from app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+semantic_stats = metrics.Counters(
+    "semantic_cache", ["lookups", "hits", "misses", "stores", "evictions", "invalidated"]
+)
+audit_stats = metrics.Counters(
+    "semantic_cache_audit", ["audits", "agreed", "false_reuse", "errors"]
+)
+
+
+def _semantic_snapshot() -> dict:
+    snap = semantic_stats.snapshot()
+    snap["hit_rate"] = metrics.rate(snap["hits"], snap["lookups"])
+    return snap
+
+
+def _audit_snapshot() -> dict:
+    snap = audit_stats.snapshot()
+    snap["false_reuse_rate"] = metrics.rate(snap["false_reuse"], snap["audits"] - snap["errors"])
+    return snap
+
+
+metrics.register("semantic_cache", _semantic_snapshot)
+metrics.register("semantic_cache_audit", _audit_snapshot)
+
+
+class SemanticVerdictCache:
+    """
+    Nearest-neighbour verdict cache over query embeddings
+
+    Usage:
+        cache = SemanticVerdictCache(max_entries=2048, max_distance=0.05, ttl_seconds=3600)
+        cache.add(vector, {"is_safe": True, ...})
+        hit = cache.lookup(other_vector)  # (verdict, distance) or None
+    """
+
+    def __init__(self, max_entries: int = 2048, max_distance: float = 0.05, ttl_seconds: int = 3600):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self._matrix: Optional[np.ndarray] = None  # allocated on first add (dimension unknown)
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._verdicts: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vector: Sequence[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm else v
+
+    def lookup(self, vector: Sequence[float]) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Closest live entry within max_distance, as (verdict, cosine distance)."""
+        semantic_stats.incr("lookups")
+        query = self._unit(vector)
+        with self._lock:
+            if self._matrix is None or self._size == 0 or query.shape[0] != self._matrix.shape[1]:
+                semantic_stats.incr("misses")
+                return None
+            similarities = self._matrix[: self._size] @ query
+            similarities[self._expires[: self._size] < time.monotonic()] = -1.0
+            best = int(np.argmax(similarities))
+            distance = 1.0 - float(similarities[best])
+            if distance > self.max_distance:
+                semantic_stats.incr("misses")
+                return None
+            verdict = dict(self._verdicts[best])
+        semantic_stats.incr("hits")
+        return verdict, distance
+
+    def add(self, vector: Sequence[float], verdict: Dict[str, Any]) -> None:
+        row = self._unit(vector)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != row.shape[0]:
+                self._matrix = np.zeros((self.max_entries, row.shape[0]), dtype=np.float32)
+                self._size = 0
+                self._next = 0
+            if self._size == self.max_entries:
+                semantic_stats.incr("evictions")
+            slot = self._next
+            self._matrix[slot] = row
+            self._expires[slot] = time.monotonic() + self.ttl_seconds
+            self._verdicts[slot] = dict(verdict)
+            self._next = (slot + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+        semantic_stats.incr("stores")
+
+    def invalidate(self, vector: Sequence[float]) -> int:
+        """Expire every live entry within max_distance of vector; returns how many."""
+        query = self._unit(vector)
+        with self._lock:
+            if self._matrix is None or self._size == 0 or query.shape[0] != self._matrix.shape[1]:
+                return 0
+            near = (1.0 - self._matrix[: self._size] @ query) <= self.max_distance
+            near &= self._expires[: self._size] >= time.monotonic()
+            self._expires[: self._size][near] = 0.0
+            count = int(near.sum())
+        semantic_stats.incr("invalidated", count)
+        return count
+
+    def clear(self) -> None:
+        with self._lock:
+            self._matrix = None
+            self._verdicts = [None] * self.max_entries
+            self._size = 0
+            self._next = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+
+def record_audit(reused: Dict[str, Any], fresh: Optional[Dict[str, Any]]) -> bool:
+    """Compare a reused verdict with a fresh judge verdict for the same prompt; True on false reuse."""
+    audit_stats.incr("audits")
+    if fresh is None:
+        audit_stats.incr("errors")
+        return False
+    if bool(fresh["is_safe"]) == bool(reused["is_safe"]):
+        audit_stats.incr("agreed")
+        return False
+    audit_stats.incr("false_reuse")
+    logger.warning(
+        f"Semantic cache false reuse: reused is_safe={reused['is_safe']}, judge said {fresh['is_safe']}"
+    )
+    return True
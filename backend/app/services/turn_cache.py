@@ -0,0 +1,87 @@
+"""
+Turn Cache
+Per-message verdicts for multi-turn conversations
+
+Chat clients resend the whole history with every request. Scanning every
+message again would make each turn cost O(history). Each message's
+verdict is cached under a hash of its content instead, so a request only
+pays for the turns that are new or were edited since the last one.
+
+KEYS:
+    sha256(policy_index_version + normalized message text)
+    Same normalization as the verdict cache, so whitespace/case changes
+    don't count as edits. Re-ingesting the policies changes the version.
+
+Only verdicts that hold for every key are cached: fallback verdicts
+(judge unavailable) and the "default" allow are rescanned next turn, and
+so are local-classifier verdicts, whose thresholds differ per key (they
+take microseconds anyway).
+"""
+
+from typing import Any, Dict, Optional
+import hashlib
+
+from app.core import metrics
+from app.services.verdict_cache import InMemoryVerdictCache, normalize_text
+
+turn_stats = metrics.Counters(
+    "conversation_turns", ["requests", "turns", "cached_turns", "scanned_turns", "blocked"]
+)
+
+
+def _turn_snapshot() -> dict:
+    snap = turn_stats.snapshot()
+    snap["cached_turn_rate"] = metrics.rate(snap["cached_turns"], snap["turns"])
+    snap["avg_scanned_per_request"] = metrics.rate(snap["scanned_turns"], snap["requests"])
+    return snap
+
+
+metrics.register("conversation_turns", _turn_snapshot)
+
+UNCACHED_SOURCES = ("fallback", "default", "classifier")
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """Text of an OpenAI-style message; content may be a string or a list of parts."""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text", "") for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return ""
+
+
+def turn_key(text: str, policy_version: str) -> str:
+    digest = hashlib.sha256(f"{policy_version}\x00{normalize_text(text)}".encode("utf-8"))
+    return f"turn:{digest.hexdigest()}"
+
+
+class TurnVerdictCache:
+    """
+    Content-hash -> verdict for individual conversation turns
+
+    Usage:
+        cache = TurnVerdictCache(max_entries=20000, ttl_seconds=3600)
+        verdict = cache.get(text, policy_version)
+        cache.set(text, policy_version, verdict)
+    """
+
+    def __init__(self, max_entries: int = 20000, ttl_seconds: int = 3600):
+        self._cache = InMemoryVerdictCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+    def get(self, text: str, policy_version: str) -> Optional[Dict[str, Any]]:
+        return self._cache.get(turn_key(text, policy_version))
+
+    def set(self, text: str, policy_version: str, verdict: Dict[str, Any]) -> None:
+        if verdict.get("source") in UNCACHED_SOURCES:
+            return
+        self._cache.set(turn_key(text, policy_version), verdict)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
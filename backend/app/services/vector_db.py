@@ -8,6 +8,7 @@ This service is responsible for:
 3. Managing the vector database connection
 
 VECTOR DB OPTIONS:
+- Default: InMemoryPolicyIndex (NumPy matrix loaded from the Chroma store)
 - Development: ChromaDB (local, no API key needed)
 - Production: Pinecone (managed, scalable, requires API key)
 
@@ -22,9 +23,16 @@ WORKFLOW:
    - Top K most similar chunks are returned
 """
 
-from typing import List, Dict, Any, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 from abc import ABC, abstractmethod
 import logging
+import os
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.core import metrics
 
 # TODO: Uncomment when ready to implement
 # from langchain.vectorstores import Chroma, Pinecone
@@ -33,6 +41,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+policy_index_stats = metrics.Counters("policy_index", ["searches"])
+
 
 class VectorDBService(ABC):
     """
@@ -277,6 +287,143 @@ class PineconeService(VectorDBService):
         return True
 
 
+class InMemoryPolicyIndex(VectorDBService):
+    """
+    In-process policy index (default for the guardrail)
+
+    The policy corpus is only a handful of 500-char chunks, so instead of
+    going through Chroma's client/collection/SQLite machinery on every scan,
+    all chunk embeddings are loaded once into a contiguous float32 matrix of
+    unit vectors. Top-k is a single matrix-vector product plus argsort.
+
+    Chunks and their embeddings come from the Chroma store written by
+    scripts/ingest.py, so nothing is re-embedded at startup.
+
+    Usage:
+        index = InMemoryPolicyIndex.from_chroma("./chroma_db", embed_query=embeddings.aembed_query)
+        docs = await index.asimilarity_search_by_vector(query_vector, k=2)
+        results = await index.search("Can I share customer data?")
+    """
+
+    def __init__(self, embed_query: Optional[Callable[[str], Awaitable[List[float]]]] = None):
+        """
+        Args:
+            embed_query: Async text -> vector function, only needed by search()
+        """
+        self.embed_query = embed_query
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._texts: List[str] = []
+        self._metadatas: List[Dict[str, Any]] = []
+        self._ids: List[Optional[str]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_chroma(cls, persist_directory: str, embed_query=None) -> "InMemoryPolicyIndex":
+        """Load every chunk (text, metadata, stored embedding) from a Chroma directory."""
+        index = cls(embed_query=embed_query)
+        if not os.path.isdir(persist_directory):
+            logger.warning(f"No policy store at {persist_directory}; run scripts/ingest.py first")
+            return index
+
+        from langchain_chroma import Chroma
+
+        store = Chroma(persist_directory=persist_directory)
+        data = store.get(include=["embeddings", "documents", "metadatas"])
+        index._load(data["documents"] or [], data["embeddings"], data["metadatas"] or [], data.get("ids"))
+        logger.info(f"Loaded {len(index)} policy chunks into the in-memory index")
+        return index
+
+    def _load(
+        self,
+        texts: List[str],
+        vectors,
+        metadatas: List[Optional[Dict[str, Any]]],
+        ids: Optional[List[Optional[str]]] = None,
+    ) -> None:
+        matrix = np.asarray(vectors if vectors is not None and len(texts) else [], dtype=np.float32)
+        if matrix.ndim != 2:
+            matrix = matrix.reshape(len(texts), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+        metadatas = [dict(m or {}) for m in metadatas] + [{}] * (len(texts) - len(metadatas))
+        ids = list(ids or []) + [None] * (len(texts) - len(ids or []))
+        with self._lock:
+            self._matrix = np.ascontiguousarray(matrix)
+            self._texts = list(texts)
+            self._metadatas = metadatas
+            self._ids = ids
+
+    def search_by_vector(
+        self,
+        vector: List[float],
+        top_k: int = 3,
+        score_threshold: float = 0.0
+    ) -> List[Dict[str, Any]]:
+        """Top-k chunks by cosine similarity, best first, as {"content", "score", "id", **metadata}."""
+        policy_index_stats.incr("searches")
+        query = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(query))
+        with self._lock:
+            matrix, texts, metadatas, ids = self._matrix, self._texts, self._metadatas, self._ids
+        if not texts or query.shape[0] != matrix.shape[1]:
+            return []
+        scores = matrix @ (query / norm if norm else query)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [
+            {**metadatas[i], "content": texts[i], "score": float(scores[i]), "id": ids[i]}
+            for i in order
+            if scores[i] >= score_threshold
+        ]
+
+    async def asimilarity_search_by_vector(self, embedding: List[float], k: int = 4) -> List[Document]:
+        """LangChain vector-store signature, so the guardrail can use it in place of Chroma."""
+        return [
+            Document(
+                id=r.pop("id"),
+                page_content=r.pop("content"),
+                metadata={key: v for key, v in r.items() if key != "score"},
+            )
+            for r in self.search_by_vector(embedding, top_k=k)
+        ]
+
+    async def search(
+        self,
+        query: str,
+        top_k: int = 3,
+        score_threshold: float = 0.7
+    ) -> List[Dict[str, Any]]:
+        """Embed the query with embed_query, then search_by_vector."""
+        if self.embed_query is None:
+            raise RuntimeError("InMemoryPolicyIndex.search() needs an embed_query function")
+        vector = await self.embed_query(query)
+        return self.search_by_vector(vector, top_k=top_k, score_threshold=score_threshold)
+
+    async def add_documents(self, documents: List[Dict[str, Any]]) -> bool:
+        """
+        Add pre-embedded chunks to the index
+
+        Args:
+            documents: List of dicts with 'text', 'embedding' and optional 'metadata' and 'id'
+        """
+        with self._lock:
+            texts, metadatas, ids = list(self._texts), list(self._metadatas), list(self._ids)
+            vectors = list(self._matrix) if texts else []
+        dims = {len(doc["embedding"]) for doc in documents} | ({len(vectors[0])} if vectors else set())
+        if len(dims) > 1:
+            logger.warning("Embedding dimension mismatch; documents not added to the policy index")
+            return False
+        self._load(
+            texts + [doc["text"] for doc in documents],
+            vectors + [doc["embedding"] for doc in documents],
+            metadatas + [doc.get("metadata") for doc in documents],
+            ids + [doc.get("id") for doc in documents],
+        )
+        return True
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+
 # Factory function to get the right DB service
 def get_vector_db_service() -> VectorDBService:
     """
@@ -297,5 +444,10 @@ def get_vector_db_service() -> VectorDBService:
     #         index_name=settings.PINECONE_INDEX_NAME
     #     )
 
+    from app.core.config import settings
+
+    if settings.VECTOR_DB_TYPE == "memory":
+        return InMemoryPolicyIndex.from_chroma(settings.CHROMA_PERSIST_DIR)
+
     # For now, return ChromaDB
     return ChromaDBService()
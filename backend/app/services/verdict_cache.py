@@ -0,0 +1,222 @@
+"""
+Verdict Cache Service
+Exact-match cache of guardrail verdicts
+
+Greetings, templated app prompts and the homepage demo strings arrive
+over and over; each one used to pay for RAG + LLM judge. This service
+remembers the judge's verdict for a normalized input.
+
+KEYS:
+    sha256(policy_index_version + normalized input)
+    Re-ingesting the policies changes the version, so stale verdicts are
+    never served against a new rule set.
+
+BACKENDS:
+- In-memory: bounded LRU with per-entry TTL (default, per worker)
+- Redis: shared across workers, TTL handled by Redis (REDIS_CACHE_ENABLED)
+  Falls back to in-memory if the redis package or server is unavailable.
+"""
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import unicodedata
+
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+cache_stats = metrics.Counters(
+    "verdict_cache", ["lookups", "hits", "misses", "stores", "evictions", "errors"]
+)
+
+
+def _cache_snapshot() -> dict:
+    snap = cache_stats.snapshot()
+    snap["hit_rate"] = metrics.rate(snap["hits"], snap["lookups"])
+    snap["backend"] = type(_cache).__name__ if _cache is not None else None
+    return snap
+
+
+metrics.register("verdict_cache", _cache_snapshot)
+
+
+def normalize_text(text: str) -> str:
+    """NFKC-fold, case-fold and collapse whitespace so trivially different inputs share a key."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def make_cache_key(text: str, policy_version: str) -> str:
+    """Stable cache key for an input under a given policy-index version."""
+    digest = hashlib.sha256(f"{policy_version}\x00{normalize_text(text)}".encode("utf-8"))
+    return f"verdict:{digest.hexdigest()}"
+
+
+class VerdictCache(ABC):
+    """
+    Abstract base class for verdict caches
+    Allows switching between in-process and Redis storage
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached verdict, or None on miss/expiry"""
+        pass
+
+    @abstractmethod
+    def set(self, key: str, verdict: Dict[str, Any]) -> None:
+        """Store a verdict under key"""
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Drop every entry"""
+        pass
+
+
+class InMemoryVerdictCache(VerdictCache):
+    """
+    Bounded LRU cache with a TTL per entry
+
+    Usage:
+        cache = InMemoryVerdictCache(max_entries=10000, ttl_seconds=3600)
+        cache.set(key, {"is_safe": True, ...})
+        cache.get(key)
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: int = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, verdict = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(verdict)
+
+    def set(self, key: str, verdict: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, dict(verdict))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                cache_stats.incr("evictions")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisVerdictCache(VerdictCache):
+    """
+    Redis-backed cache shared by every worker
+
+    Entries are JSON strings stored with SETEX, so Redis handles expiry
+    and its own maxmemory policy handles eviction.
+    """
+
+    def __init__(self, url: str, ttl_seconds: int = 3600):
+        import redis  # optional dependency
+
+        self.ttl_seconds = ttl_seconds
+        self.client = redis.Redis.from_url(
+            url, socket_connect_timeout=0.5, socket_timeout=0.5, decode_responses=True
+        )
+        self.client.ping()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = self.client.get(key)
+        return json.loads(raw) if raw else None
+
+    def set(self, key: str, verdict: Dict[str, Any]) -> None:
+        self.client.setex(key, self.ttl_seconds, json.dumps(verdict))
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(match="verdict:*"):
+            self.client.delete(key)
+
+
+_cache: Optional[VerdictCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_verdict_cache() -> VerdictCache:
+    """
+    Factory: Redis when REDIS_CACHE_ENABLED and reachable, else in-memory LRU.
+    Built once per process on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = _build_cache()
+    return _cache
+
+
+def _build_cache() -> VerdictCache:
+    if settings.REDIS_CACHE_ENABLED:
+        try:
+            cache = RedisVerdictCache(settings.REDIS_URL, ttl_seconds=settings.CACHE_TTL)
+            logger.info(f"Verdict cache: Redis at {settings.REDIS_URL}")
+            return cache
+        except Exception as e:
+            logger.warning(f"Verdict cache: Redis unavailable ({type(e).__name__}), using in-memory LRU")
+    return InMemoryVerdictCache(
+        max_entries=settings.VERDICT_CACHE_MAX_ENTRIES, ttl_seconds=settings.CACHE_TTL
+    )
+
+
+def lookup_verdict(key: str) -> Optional[Dict[str, Any]]:
+    """Cache read that never raises; a broken backend counts as a miss."""
+    cache_stats.incr("lookups")
+    try:
+        verdict = get_verdict_cache().get(key)
+    except Exception as e:
+        cache_stats.incr("errors")
+        logger.warning(f"Verdict cache read failed: {e}")
+        verdict = None
+    cache_stats.incr("hits" if verdict is not None else "misses")
+    return verdict
+
+
+def store_verdict(key: str, verdict: Dict[str, Any]) -> None:
+    """Cache write that never raises."""
+    try:
+        get_verdict_cache().set(key, verdict)
+        cache_stats.incr("stores")
+    except Exception as e:
+        cache_stats.incr("errors")
+        logger.warning(f"Verdict cache write failed: {e}")
+
+
+async def alookup_verdict(key: str) -> Optional[Dict[str, Any]]:
+    """Async read: in-memory lookups run inline, Redis round trips run off the event loop."""
+    if isinstance(get_verdict_cache(), InMemoryVerdictCache):
+        return lookup_verdict(key)
+    return await asyncio.to_thread(lookup_verdict, key)
+
+
+async def astore_verdict(key: str, verdict: Dict[str, Any]) -> None:
+    """Async write, same threading rule as alookup_verdict."""
+    if isinstance(get_verdict_cache(), InMemoryVerdictCache):
+        store_verdict(key, verdict)
+    else:
+        await asyncio.to_thread(store_verdict, key, verdict)
@@ -0,0 +1,84 @@
+"""
+Train the local classifier tier from labelled scan logs.
+
+Reads a JSONL export of scans (one {"text": ..., "is_safe": ...} or
+{"text": ..., "label": 0|1} object per line), trains the hashed n-gram
+logistic regression and writes a versioned .npz artifact. Point
+LOCAL_CLASSIFIER_PATH at the output to serve it.
+
+Usage (from the 'backend' directory):
+    python -m scripts.train_classifier data/scan_logs.jsonl --out data/local_classifier.npz
+"""
+
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+import numpy as np
+
+from app.chains.classifier import HashedNgramClassifier, read_labelled
+from app.core.config import settings
+
+DEFAULT_OUT = "./data/local_classifier.npz"
+
+
+def train_classifier(
+    logs_path: str,
+    out_path: str = DEFAULT_OUT,
+    holdout: float = 0.1,
+    epochs: int = 8,
+    version: str = "",
+) -> HashedNgramClassifier:
+    """
+    Train on logs_path and save the artifact to out_path.
+
+    Raises:
+        FileNotFoundError: If the log file doesn't exist
+        ValueError: If it contains no labelled records
+    """
+    print("🚀 Training local classifier...")
+    if not os.path.exists(logs_path):
+        raise FileNotFoundError(f"❌ Error: scan log export not found at {logs_path}")
+
+    with open(logs_path, encoding="utf-8") as f:
+        texts, labels = read_labelled(json.loads(line) for line in f if line.strip())
+    if not texts:
+        raise ValueError(f"❌ No labelled records in {logs_path}")
+    print(f"📄 Loaded {len(texts)} labelled scans ({sum(labels)} unsafe)")
+
+    order = list(range(len(texts)))
+    random.Random(0).shuffle(order)
+    n_test = int(len(order) * holdout)
+    test, train = order[:n_test], order[n_test:]
+
+    version = version or datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    model = HashedNgramClassifier.train(
+        [texts[i] for i in train], [labels[i] for i in train], epochs=epochs, version=version
+    )
+
+    if test:
+        p = np.array([model.predict_proba(texts[i]) for i in test])
+        y = np.array([labels[i] for i in test])
+        allow, block = settings.LOCAL_CLASSIFIER_ALLOW_BELOW, settings.LOCAL_CLASSIFIER_BLOCK_ABOVE
+        decided = (p <= allow) | (p >= block)
+        wrong = decided & ((p >= block) != (y == 1))
+        print(f"📊 Holdout accuracy (p >= 0.5): {np.mean((p >= 0.5) == (y == 1)):.3f}")
+        print(f"📊 Decided locally at ({allow}, {block}): {np.mean(decided):.1%}, "
+              f"wrong among those: {wrong.sum()} / {decided.sum()}")
+
+    model.save(out_path)
+    print(f"🎉 Saved classifier {model.version} to {out_path}")
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("logs", help="JSONL export of labelled scans")
+    parser.add_argument("--out", default=DEFAULT_OUT)
+    parser.add_argument("--holdout", type=float, default=0.1)
+    parser.add_argument("--epochs", type=int, default=8)
+    parser.add_argument("--version", default="")
+    args = parser.parse_args()
+    train_classifier(args.logs, args.out, args.holdout, args.epochs, args.version)
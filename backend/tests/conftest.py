@@ -4,8 +4,14 @@ Pytest fixtures: shared client and mocks so tests don't call real LLM/Chroma.
 import pytest
 from fastapi.testclient import TestClient
 
-# Import app after env is set so guardrail doesn't fail on missing OPENROUTER_API_KEY
+# Guardrail clients are built lazily, so importing the app needs no OpenRouter env vars
 from app.main import app, API_KEY_MAPPING
+from app.chains import guardrail
+from app.services import verdict_cache
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.embedding_cache import EmbeddingCache
+from app.services.semantic_cache import SemanticVerdictCache
+from app.services.turn_cache import TurnVerdictCache
 
 
 @pytest.fixture
@@ -20,3 +26,53 @@ def reset_api_key_mapping():
     yield
     API_KEY_MAPPING.clear()
     API_KEY_MAPPING.update(before)
+
+
+@pytest.fixture(autouse=True)
+def fresh_verdict_cache(monkeypatch):
+    """Per-test in-memory verdict caches (no Redis, no cross-test hits, no random audits)."""
+    monkeypatch.setattr(guardrail.settings, "SEMANTIC_CACHE_AUDIT_RATE", 0.0)
+    monkeypatch.setattr(verdict_cache, "_cache", verdict_cache.InMemoryVerdictCache())
+    monkeypatch.setattr(guardrail.engine, "semantic_cache", SemanticVerdictCache(max_entries=16))
+    monkeypatch.setattr(guardrail.engine, "embedding_cache", EmbeddingCache(model="test", max_entries=16))
+    monkeypatch.setattr(guardrail.engine, "turn_cache", TurnVerdictCache(max_entries=16))
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    """Closed circuit breakers per test, so failures in one test can't open them for the next."""
+    monkeypatch.setattr(guardrail.engine, "judge_breaker", CircuitBreaker("judge", failure_threshold=5))
+    monkeypatch.setattr(guardrail.engine, "embedding_breaker", CircuitBreaker("embeddings", failure_threshold=5))
+
+
+@pytest.fixture
+def fake_rag(monkeypatch):
+    """
+    Deterministic embeddings keyed on the first word (so paraphrases land close
+    together) and an empty in-memory policy store, installed on the engine.
+    """
+
+    class FakeEmbeddings:
+        query_calls = 0
+        document_calls = 0
+
+        def embed_query(self, text):
+            word = text.lower().split()[0] if text.split() else ""
+            return [float(ord(c)) for c in (word + "    ")[:4]]
+
+        async def aembed_query(self, text):
+            self.query_calls += 1
+            return self.embed_query(text)
+
+        async def aembed_documents(self, texts):
+            self.document_calls += 1
+            return [self.embed_query(t) for t in texts]
+
+    class FakeVectorDB:
+        async def asimilarity_search_by_vector(self, vector, k=2):
+            return []
+
+    fake = FakeEmbeddings()
+    monkeypatch.setattr(guardrail.engine, "_embeddings", fake)
+    monkeypatch.setattr(guardrail.engine, "_vector_db", FakeVectorDB())
+    return fake